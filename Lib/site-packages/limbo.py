@@ -4,7 +4,11 @@
 # To debug the front-end can be a bit difficult. It's recommended to open the
 # developer console of your web browser (ctrl+shift+J in firefox)
 
-from browser import doc, alert, ajax, window
+import json
+import time
+from browser import doc, html, alert, ajax, window, timer
+from browser.indexed_db import IndexedDB
+from browser.websocket import websocket
 
 class Keycode():
     enter = 13
@@ -30,25 +34,283 @@ def timeout_error():
 def notify(text):
     alert(text)
 
-def request(async, _on_complete=None, **kwargs):
+def dollars(cents):
+    """The server sends amounts of money as integer cents; this formats them
+       for display, without the dollar sign."""
+    return '%.2f' % (cents / 100)
+
+def js_object():
+    """An empty javascript object, to look strings up in. Brython's own dict
+       compares the key with each of its keys in turn, which is far too slow
+       for a few thousand items."""
+    return window.JSON.parse('{}')
+
+class KeyedOptions():
+    """The options of a <select>, each with a key (usually the item name) as
+       its value, and the text describe(key, value) for some value, such as a
+       count and a price. render() is given every (key, value) to show, and
+       only changes the options which were added, removed, moved or whose value
+       changed, so that the selection and the scroll position survive, and
+       re-rendering a long list after a small change costs little."""
+    def __init__(self, select, describe):
+        self.select = select
+        self.describe = describe
+        # In the order shown:
+        self.keys = []
+        self.values = []
+        self.options = []
+
+    def render(self, rows):
+        """rows are (key, value) in the order to show them."""
+        keys = [key for key, value in rows]
+        if keys == self.keys:
+            # Only some values changed, as on most clicks and keypresses.
+            for i in range(len(rows)):
+                if self.values[i] != rows[i][1]:
+                    self.values[i] = rows[i][1]
+                    self.options[i].text = self.describe(*rows[i])
+            return
+        # Where each option kept is now; -1 for new ones and -2 for those to
+        # be removed. Every key is set first, as getattr() can't be told to
+        # return a default for javascript objects.
+        position = js_object()
+        for key in self.keys:
+            setattr(position, key, -2)
+        for key in keys:
+            setattr(position, key, -1)
+        kept = []
+        for i in range(len(self.keys)):
+            if getattr(position, self.keys[i]) == -2:
+                self.select.removeChild(self.options[i])
+            else:
+                setattr(position, self.keys[i], i)
+                kept.append(i)
+        # Rows are placed one by one before the first option kept which
+        # hasn't been placed yet.
+        placed = [False] * len(self.keys)
+        next_kept = 0
+        options = []
+        for key, value in rows:
+            while next_kept < len(kept) and placed[kept[next_kept]]:
+                next_kept += 1
+            i = getattr(position, key)
+            if i == -1:
+                option = html.OPTION(self.describe(key, value), value=key)
+            else:
+                placed[i] = True
+                option = self.options[i]
+                if self.values[i] != value:
+                    option.text = self.describe(key, value)
+            options.append(option)
+            if next_kept < len(kept) and kept[next_kept] == i:
+                next_kept += 1 # already in place
+            elif next_kept < len(kept):
+                self.select.insertBefore(option, self.options[kept[next_kept]])
+            else:
+                self.select.appendChild(option)
+        self.keys = keys
+        self.values = [value for key, value in rows]
+        self.options = options
+
+class ResponseCache():
+    """Keeps the responses to cached_request() which carry an ETag (those of
+       actions which only read) in the browser's IndexedDB, with the ETag they
+       were fetched at. A page can then show them right away, and the server
+       only sends them again if they have changed. Only the max_entries
+       responses stored last are kept. Without IndexedDB everything still
+       works, only without the cache."""
+    name = 'limbo4'
+    store = 'responses'
+    open_timeout = 1 # seconds to wait for the database before going without
+    max_entries = 20 # responses kept; the oldest stored are dropped first
+
+    def __init__(self):
+        self.db = None
+        self.native_db = None # the same database, for what self.db lacks
+        self.ready = False
+        self.waiting = [] # lookups made before the database was open
+        try:
+            self.idb = IndexedDB()
+            self.idb.open(self.name, self.opened, version=2,
+                          onupgradeneeded=self.upgrade)
+            timer.set_timeout(self.set_ready, self.open_timeout * 1000)
+        except NotImplementedError:
+            self.set_ready()
+
+    def upgrade(self, event):
+        # Version 1 stored responses without the time they were stored.
+        db = event.target.result
+        if db.objectStoreNames.contains(self.store):
+            db.deleteObjectStore(self.store)
+        db.createObjectStore(self.store)
+
+    def opened(self, event):
+        self.db = self.idb
+        self.native_db = event.target.result
+        self.set_ready()
+
+    def set_ready(self):
+        if not self.ready:
+            self.ready = True
+            for lookup in self.waiting:
+                lookup()
+            self.waiting = []
+
+    def get(self, key, callback):
+        """Calls callback(etag, text) with the cached response to a request,
+           or with (None, None)."""
+        def lookup():
+            if self.db is None:
+                callback(None, None)
+                return
+            def found(event):
+                value = event.target.pyresult()
+                if value is None:
+                    callback(None, None)
+                else:
+                    etag, text = json.loads(value.partition(' ')[2])
+                    callback(etag, text)
+            def failed(event):
+                callback(None, None)
+            transaction = self.db.transaction([self.store], 'readonly')
+            transaction.objectStore(self.store).get(key, onsuccess=found,
+                                                    onerror=failed)
+        if self.ready:
+            lookup()
+        else:
+            self.waiting.append(lookup)
+
+    def put(self, key, etag, text):
+        if self.db is None:
+            return
+        # Values start with the time they were stored, so that evict() can
+        # find the oldest without parsing them.
+        value = '%s %s' % (int(time.time() * 1000), json.dumps([etag, text]))
+        transaction = self.db.transaction([self.store], 'readwrite')
+        transaction.objectStore(self.store).put(value, key,
+                                                onsuccess=self.evict)
+
+    def evict(self, event=None):
+        """Deletes all but the max_entries responses stored last."""
+        store = self.native_db.transaction([self.store],
+                                           'readwrite').objectStore(self.store)
+        stored = [] # (time stored, key)
+        def found(event):
+            cursor = event.target.result
+            if cursor is not None:
+                stored.append((int(cursor.value.partition(' ')[0]),
+                               cursor.key))
+                getattr(cursor, 'continue')() # a keyword in python
+            elif len(stored) > self.max_entries:
+                stored.sort()
+                for stored_at, key in stored[:len(stored) - self.max_entries]:
+                    store.delete(key)
+        store.openCursor().onsuccess = found
+
+cache = ResponseCache()
+
+def response_header(req, name):
+    for line in req.headers:
+        header, _, value = line.partition(':')
+        if header.strip().lower() == name.lower():
+            return value.strip()
+    return None
+
+def request(async, _on_complete=None, action=None, _show_cached=False,
+            **kwargs):
     """All calls go to cgi-bin/limbo.py; exactly what is done depends on the
-       arguments passed. """
-    req = ajax.ajax()
-    def callback(req):
-        _on_complete(eval(req.text))
-    if _on_complete is not None:
-        req.bind('complete', callback)
-    req.set_timeout(timeout, timeout_error)
-    req.open('POST', 'cgi-bin/limbo-cgi.py', async=async)
-    req.set_header('content-type', 'application/x-www-form-urlencoded')
-    req.send(kwargs)
+       arguments passed. Arguments are plain python values (strings, numbers,
+       lists, dicts); they are sent as JSON, and so is the reply, which the
+       browser parses natively.
+
+       With _show_cached, replies are cached (see ResponseCache), and only sent
+       again by the server if they have changed; _on_complete is called with
+       the cached reply as soon as it is found, and then only again if the
+       server's reply is different. Other requests go straight to the
+       server."""
+    form = dict((key, json.dumps(value)) for key, value in kwargs.items())
+    form['action'] = action
+    form['format'] = 'json'
+    key = '&'.join('%s=%s' % (name, form[name]) for name in sorted(form))
+    def send(etag, cached):
+        if _show_cached and cached is not None:
+            _on_complete(json.loads(cached))
+        req = ajax.ajax()
+        def callback(req):
+            if req.status == 304:
+                text = cached
+            else:
+                text = req.text
+                new_etag = response_header(req, 'ETag')
+                if _show_cached and new_etag:
+                    cache.put(key, new_etag, text)
+            if _show_cached and text == cached:
+                return # already shown
+            _on_complete(json.loads(text))
+        if _on_complete is not None:
+            req.bind('complete', callback)
+        req.set_timeout(timeout, timeout_error)
+        req.open('POST', 'cgi-bin/limbo-cgi.py', async=async)
+        req.set_header('content-type', 'application/x-www-form-urlencoded')
+        if etag is not None:
+            req.set_header('If-None-Match', etag)
+        req.send(form)
+    if _show_cached:
+        cache.get(key, send)
+    else:
+        send(None, None)
 
 def async_request(on_complete=None, **kwargs):
     request(async=True, _on_complete=on_complete, **kwargs)
+
+def cached_request(on_complete=None, **kwargs):
+    """Like async_request, but on_complete is called with the cached reply
+       right away if there is one, and again only if the server's is
+       different."""
+    request(async=True, _on_complete=on_complete, _show_cached=True, **kwargs)
     
 def sync_request(on_complete=None, **kwargs):
     request(async=False, _on_complete=on_complete, **kwargs)
 
+# push.py, on this port of the same host, sends changes as they happen.
+push_port = 8001
+push_retry = 5 # seconds to wait before connecting again
+
+def listen(on_changes, on_open=None):
+    """Calls on_changes with every batch of changes the push server sends, as
+       the changes_since action would return them. on_open is called whenever
+       the connection is made, also again after it was lost, so that the page
+       can catch up on what it missed meanwhile. Without WebSockets or without
+       the push server, pages simply don't update by themselves."""
+    if not hasattr(window, 'WebSocket'):
+        return
+    protocol = 'wss' if window.location.protocol == 'https:' else 'ws'
+    url = '%s://%s:%i/' % (protocol, window.location.hostname, push_port)
+    def opened(event):
+        if on_open is not None:
+            on_open()
+    def message(event):
+        on_changes(json.loads(event.data))
+    def closed(event):
+        timer.set_timeout(connect, push_retry * 1000)
+    def connect():
+        socket = websocket(url)
+        socket.bind('open', opened)
+        socket.bind('message', message)
+        socket.bind('close', closed)
+    connect()
+
+def download(action, **kwargs):
+    """Has the browser download the file an action produces (see Download on
+       the server). Arguments are sent as JSON, like those of request(), in
+       the query string."""
+    form = dict((key, json.dumps(value)) for key, value in kwargs.items())
+    form['action'] = action
+    form['format'] = 'json'
+    window.location.href = ('cgi-bin/limbo-cgi.py?' +
+        '&'.join('%s=%s' % (name, window.encodeURIComponent(form[name]))
+                 for name in sorted(form)))
+
 def redirect(url, **kwargs):
     window.location.href = (url + '?' +
         '&'.join('%s=%s' % (key, value) for key, value in kwargs.items()))
@@ -0,0 +1,889 @@
+#!/usr/bin/python3
+# Backend to Limbo4. These are the actions a client may request; they are served
+# either by the long-running server in wsgi.py or by cgi-bin/limbo-cgi.py.
+import io
+import re
+import ast
+import csv
+import json
+import heapq
+import hashlib
+import threading
+from server import *
+from search import SearchIndex
+
+def initialize_test_database():
+    """This function should only be called on an empty new database. This
+       function should also be where you create fake users/items for testing."""
+    with DBConnection() as conn:
+        Users.create(conn)
+        Items.create(conn)
+        Sellers.create(conn)
+        Purchases.create(conn)
+        Transfers.create(conn)
+        BalanceChanges.create(conn)
+        Stocking.create(conn)
+        Donations.create(conn)
+        ExpiryEvents.create(conn)
+        Statistics.create(conn)
+        Ledger.create(conn)
+        LedgerCheckpoints.create(conn)
+    migrate()
+    # A new database at the same path would look like the old one.
+    item_search.reset()
+    return True
+
+def delete_test_database():
+    """Delete the database. Be careful! Also rebuilds the database."""
+    import os
+    pool.close_all()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(sql_database + suffix):
+            os.remove(sql_database + suffix)
+    return initialize_test_database()
+
+class OutOfStock(Exception):
+    """Raised inside a transaction to roll it back when an item doesn't have
+       enough stock for a purchase."""
+
+def sell_item(conn, date, itemname, buyername, count):
+    """Records the purchase of any amount of a single item within a
+       transaction, and returns the item's new count. Raises OutOfStock if
+       there isn't enough of the item."""
+    assert isinstance(count, int) and count > 0
+    item = Items.select_one(conn, "Name=?", itemname)
+    if item is None:
+        raise OutOfStock(itemname)
+    sellers = Sellers.select(conn, "ItemName=?", itemname)
+    total_price = item.Price * count
+
+    # Subtract count from the item. If count is zero, then remove the item
+    # record. If the count goes below zero, we have an error.
+    new_count = item.Count - count
+    if new_count < 0:
+        raise OutOfStock(itemname)
+    elif new_count == 0:
+        Items.delete(conn, "Name=?", itemname)
+        Sellers.delete(conn, "ItemName=?", itemname)
+    else:
+        Items.update(conn, "Count=?", "Name=?", new_count, itemname)
+
+    # Subtract money from buyer
+    adjust_balance(conn, date, buyername, -total_price, 'purchase')
+
+    for seller in sellers:
+        # Record the transaction
+        Purchases.insert(conn, itemname, date, item.StockDate,
+                         item.ExpiryDate, buyername, seller.Seller,
+                         seller.ProfitSplit, item.Price, count, item.Tax)
+        # Add money to seller
+        adjust_balance(conn, date, seller.Seller,
+                       share(total_price, seller.ProfitSplit), 'sale')
+    return new_count
+
+def checkout(itemname, buyername, count):
+    """Buyer checkouts any amount of a single item. Returns what changed (see
+       select_write_result), or False if there isn't enough of the item, in
+       which case nothing is recorded."""
+    date = datetime.datetime.now()
+    try:
+        with DBConnection() as conn:
+            version = change_version(conn)
+            sell_item(conn, date, itemname, buyername, count)
+            return select_write_result(conn, version, buyername, date)
+    except OutOfStock:
+        return False
+
+def checkout_cart(buyername, cart, payment='0'):
+    """Buyer checkouts a whole cart, given as a dictionary of item names to
+       counts, and pays (or withdraws, if negative) some amount, all in one
+       transaction: either everything is recorded or nothing is. Returns what
+       changed (see select_write_result), or False if any item doesn't have
+       enough stock."""
+    payment = cents(payment)
+    date = datetime.datetime.now()
+    try:
+        with DBConnection() as conn:
+            version = change_version(conn)
+            for itemname, count in cart.items():
+                sell_item(conn, date, itemname, buyername, count)
+            if payment != 0:
+                record_balance_change(conn, date, buyername, payment)
+            return select_write_result(conn, version, buyername, date)
+    except OutOfStock:
+        return False
+
+def add_item(itemname, sellers, count, price_each, tax, expiry_time_in_weeks,
+             description='', username=None):
+    """Adds an item as being in-stock and stocked by certain sellers.
+       Returns what changed, with the new history entries of username if
+       given (see select_write_result)."""
+    assert isinstance(count, int)
+    assert isinstance(expiry_time_in_weeks, int)
+    price_each = cents(price_each)
+    tax = basis_points(tax)
+
+    duration = datetime.timedelta(weeks=expiry_time_in_weeks)
+    stockdate = datetime.datetime.now()
+    expirydate = stockdate + duration
+    
+    # If a seller's profit_split is marked as None, then they will
+    # receive the remainder of profits.
+    profits_remainder = 10000 - tax
+    for profit_split in sellers.values():
+        if profit_split is not None:
+            profits_remainder -= basis_points(profit_split)
+    
+    with DBConnection() as conn:
+        version = change_version(conn)
+        Items.insert(conn, itemname, count, price_each, tax,
+                                 stockdate, expirydate, description)
+        for seller, profit_split in sellers.items():
+            if profit_split is None:
+                profit_split = profits_remainder
+            else:
+                profit_split = basis_points(profit_split)
+            Sellers.insert(conn, itemname, seller, profit_split)
+            Stocking.insert(conn,
+                            itemname, stockdate, stockdate, expirydate,
+                            seller, profit_split, price_each, 0,
+                            count, tax)
+        return select_write_result(conn, version, username, stockdate)
+
+def add_user(username, email, uid=0):
+    """Creates a new user and inserts into the database.
+       Returns True if successful"""
+    assert isinstance(uid, int)
+    with DBConnection() as conn:
+        balance = 0
+        joindate = datetime.datetime.now()
+        Users.insert(conn, username, email, balance, uid, joindate)
+    return True
+
+def get_all_stock():
+    """Returns all items stocked and all the associated data."""
+    with DBConnection(readonly=True) as conn:
+        return list(Items.select(conn, None))
+
+def get_fraction_by_sellers(itemname):
+    """Returns a dictionary with sellers as keys, profit fractions as values."""
+    with DBConnection(readonly=True) as conn:
+        rows = Sellers.select(conn, "ItemName=?", itemname)
+    return dict((row.Seller, row.ProfitSplit) for row in rows)
+
+def get_all_sellers():
+    """Returns a dictionary with item names as keys, seller lists as values."""
+    with DBConnection(readonly=True) as conn:
+        rows = Sellers.select(conn, None, columns=('ItemName', 'Seller'))
+    sellers_by_item = {}
+    for row in rows:
+        if row.ItemName in sellers_by_item:
+            sellers_by_item[row.ItemName].append(row.Seller)
+        else:
+            sellers_by_item[row.ItemName] = [row.Seller]
+    return sellers_by_item
+
+def get_user_stock(username):
+    """Returns all item names which list the given username as a seller."""
+    rows = []
+    with DBConnection(readonly=True) as conn:
+        for row in Sellers.iterate(conn, "Seller=?", username,
+                                   columns=('ItemName',)):
+            rows.append(row.ItemName)
+    return rows
+
+def get_usernames():
+    """Returns a list of all usernames."""
+    names = []
+    with DBConnection(readonly=True) as conn:
+        for row in Users.iterate(conn, None, columns=('Name',)):
+            names.append(row.Name)
+    return names
+
+def get_username(username):
+    """Returns the information on a username if it exists, otherwise False."""
+    with DBConnection(readonly=True) as conn:
+        t = Users.select_one(conn, "Name=?", username)
+    return t
+
+def select_stock(conn):
+    """Returns all items in stock and a dictionary of the sellers of each."""
+    # Each item comes with its sellers, separated by the ASCII unit separator.
+    all_stock = []
+    sellers_by_item = {}
+    for row in conn.execute("SELECT Items.*, "
+                            "group_concat(Sellers.Seller, char(31)) "
+                            "FROM Items LEFT JOIN Sellers "
+                            "ON Sellers.ItemName = Items.Name "
+                            "GROUP BY Items.Name ORDER BY Items.rowid"):
+        item = Items.Tuple(*row[:-1])
+        all_stock.append(item)
+        if row[-1] is not None:
+            sellers_by_item[item.Name] = row[-1].split('\x1f')
+    return all_stock, sellers_by_item
+
+def get_stock():
+    """All items in stock and their sellers, for the store page."""
+    with DBConnection(readonly=True) as conn:
+        return select_stock(conn)
+
+def select_changes(conn, version):
+    """Returns what changed in the items, their sellers and the users after the
+       given version (see ChangeLog), as a dictionary with
+         version:       the current version, to ask from next time
+         items:         the items inserted or updated, as full rows
+         deleted_items: the names of the items deleted
+         sellers:       for each item whose sellers changed, all its current
+                        (seller, profit split) pairs; empty if it has none left
+         users:         the names of the users inserted or updated; their
+                        emails, IDs and balances are not sent
+         deleted_users: the names of the users deleted
+       Version 0 gives everything."""
+    def changed(table, what, exists):
+        # The rows of the table named in the log, or the names logged which
+        # no longer have a row.
+        return conn.execute(
+            "SELECT %s FROM ChangeLog LEFT JOIN %s ON %s.Name = ChangeLog.Name "
+            "WHERE ChangeLog.Tab='%s' AND ChangeLog.Id > ? AND %s.Name IS %s "
+            "ORDER BY ChangeLog.Id" % (what, table.name, table.name, table.name,
+                                       table.name,
+                                       "NOT NULL" if exists else "NULL"),
+            (version,))
+    changes = dict(version=change_version(conn))
+    changes["items"] = [Items.Tuple(*row) for row in
+                        changed(Items, "Items.*", True)]
+    changes["users"] = [name for (name,) in changed(Users, "Users.Name", True)]
+    for key, table in (("items", Items), ("users", Users)):
+        changes["deleted_" + key] = [name for (name,) in
+                                     changed(table, "ChangeLog.Name", False)]
+    changes["sellers"] = sellers = {}
+    for itemname, seller, split in conn.execute(
+            "SELECT ChangeLog.Name, Sellers.Seller, Sellers.ProfitSplit "
+            "FROM ChangeLog LEFT JOIN Sellers "
+            "ON Sellers.ItemName = ChangeLog.Name "
+            "WHERE ChangeLog.Tab='Sellers' AND ChangeLog.Id > ? "
+            "ORDER BY ChangeLog.Id, Sellers.rowid", (version,)):
+        splits = sellers.setdefault(itemname, [])
+        if seller is not None:
+            splits.append((seller, split))
+    return changes
+
+def get_changes_since(version=0):
+    """The changes to items, sellers and users since the version a client last
+       saw; see select_changes."""
+    with DBConnection(readonly=True) as conn:
+        return select_changes(conn, version)
+
+class ItemSearch():
+    """The search index of the items in stock (see search.py), kept for as
+       long as the process runs, and brought up to date from the ChangeLog
+       before each search. It is built again when the database changes: when
+       another file is used, or when the ChangeLog starts over because the
+       database was created anew."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets the index, to build it again on the next search."""
+        with self.lock:
+            self.index = None
+            self.database = None
+            self.version = None
+
+    def update(self, conn):
+        version = change_version(conn)
+        database = conn.execute("PRAGMA database_list").fetchone()[2]
+        if self.index is not None and (database != self.database or
+                                       version < self.version):
+            self.index = None
+        if self.index is None:
+            self.index = SearchIndex()
+            for name, description in conn.execute(
+                    "SELECT Name, Description FROM Items"):
+                self.index.add(name, description or '')
+            self.database = database
+        elif version > self.version:
+            changes = select_changes(conn, self.version)
+            for item in changes['items']:
+                self.index.add(item.Name, item.Description or '')
+            for name in changes['deleted_items']:
+                self.index.remove(name)
+        self.version = version
+
+    def search(self, conn, query, limit=None):
+        with self.lock:
+            self.update(conn)
+            return self.index.search(query, limit)
+
+    def similar(self, conn, name, description='', limit=None):
+        with self.lock:
+            self.update(conn)
+            return self.index.similar(name, description, limit)
+
+item_search = ItemSearch()
+
+def search_items(query, limit=20):
+    """The names of the items in stock which best match query, best first,
+       for the store page's search box. The query is sent back with them, as
+       the page may have asked again before they arrive."""
+    with DBConnection(readonly=True) as conn:
+        return {'query': query,
+                'items': item_search.search(conn, query, limit)}
+
+def get_similar_items(itemname, description='', limit=5):
+    """The names of the items in stock most like a new item, most alike first,
+       shown to its seller while they type its name so that they don't stock
+       the same thing under another name. The name is sent back with them."""
+    with DBConnection(readonly=True) as conn:
+        return {'itemname': itemname,
+                'items': item_search.similar(conn, itemname, description,
+                                             limit)}
+
+def get_store_info(username):
+    """This request returns all the information needed when store.html loads.
+       This includes the username, all in-stock items, all items being sold by
+       the user, and the first page of that user's history (see
+       select_history_page)."""
+    if not username:
+        return False
+    # Everything is read in one transaction, so the page sees a consistent
+    # snapshot of the store.
+    with DBConnection(readonly=True) as conn:
+        userinfo = Users.select_one(conn, "Name=?", username)
+        all_stock, sellers_by_item = select_stock(conn)
+        user_stock = [item.Name for item in all_stock
+                      if username in sellers_by_item.get(item.Name, ())]
+        usernames = [row.Name for row in
+                     Users.iterate(conn, None, columns=('Name',))]
+        history = select_history_page(conn, username)
+    return (userinfo, all_stock, usernames, user_stock,
+            sellers_by_item, history)
+
+def get_item_info(itemname):
+    """Returns count, price, stock date, expiry date, description of an item."""
+    with DBConnection(readonly=True) as conn:
+        row = Items.select_one(conn, "Name=?", itemname)
+    return row.Count, row.Price, row.StockDate, row.ExpiryDate, row.Description
+
+def addremove_item(itemname, count_to_add, username=None):
+    """Modifies stock by altering item count only. Returns what changed, with
+       the new history entries of username if given (see
+       select_write_result), or False if there isn't that much to remove."""
+    assert isinstance(count_to_add, int)
+    date = datetime.datetime.now()
+    with DBConnection() as conn:
+        version = change_version(conn)
+        row = Items.select_one(conn, "Name=?", itemname)
+        _, count, price, tax, stockdate, expirydate, _ = row
+        new_count = count + count_to_add
+        if new_count < 0:
+            return False
+        
+        rows = Sellers.select(conn, "ItemName=?", itemname)
+        profit_splits_by_seller = dict((row.Seller, row.ProfitSplit)
+                                       for row in rows)
+        
+        if new_count == 0:
+            Sellers.delete(conn, "ItemName=?", itemname)
+            Items.delete(conn, "Name=?", itemname)
+        else:
+            Items.update(conn, "Count=?", "Name=?", new_count, itemname)
+
+        for seller, profit_split in profit_splits_by_seller.items():
+            # Record this stock change
+            Stocking.insert(conn, itemname, date, stockdate, expirydate,
+                                seller, profit_split, price, count,
+                                new_count, tax)
+        return select_write_result(conn, version, username, date)
+
+def select_user_transactions(conn, username):
+    purchases = Purchases.select(conn, "Buyer=? OR Seller=?",
+                                 username, username)
+    transfers = Transfers.select(conn, "Sender=? OR Receiver=?",
+                                 username, username)
+    balances = BalanceChanges.select(conn, "User=?", username)
+    stocks = Stocking.select(conn, "Seller=?", username)
+    expiries = ExpiryEvents.select(conn, "Seller=?", username)
+    return purchases, transfers, balances, stocks, expiries
+
+# The tables making up a user's history, with the kind of entry each holds and
+# the columns naming the user. Entries are ordered newest first by (Date, the
+# position of their table here, rowid), so that entries with the same date
+# still have a fixed order.
+history_sources = [
+    ("purchase", Purchases,      ("Buyer", "Seller")),
+    ("transfer", Transfers,      ("Sender", "Receiver")),
+    ("balance",  BalanceChanges, ("User",)),
+    ("stock",    Stocking,       ("Seller",)),
+    ("expiry",   ExpiryEvents,   ("Seller",)),
+]
+
+history_page_size = 50
+max_history_page_size = 500 # the most entries a client may ask for at once
+
+def history_stream(conn, rank, column, username, before):
+    """Yields ((Date, rank, rowid), row) for the rows of a history table which
+       name the user in the given column and come after the cursor before,
+       newest first. Rows are read lazily through the (column, Date) index."""
+    kind, table, columns = history_sources[rank]
+    where = "%s=?" % column
+    args = ()
+    if before is not None:
+        date, before_rank, before_rowid = before
+        if rank < before_rank:
+            where += " AND Date<=?"
+            args = (date,)
+        elif rank == before_rank:
+            where += " AND Date<=? AND (Date<? OR rowid<?)"
+            args = (date, date, before_rowid)
+        else:
+            where += " AND Date<?"
+            args = (date,)
+    for row in table.iterate(conn, where, username, *args,
+                             columns=('rowid',) + tuple(table.fieldnames),
+                             order_by="Date DESC, rowid DESC"):
+        yield (row.Date, rank, row.rowid), table.Tuple(*row[1:])
+
+def same_purchase(a, b):
+    """Whether two rows of Purchases are the shares of different sellers in
+       one purchase."""
+    return (a.Date, a.ItemName, a.Buyer) == (b.Date, b.ItemName, b.Buyer)
+
+def history_record(kind, rows):
+    """Turns the rows of one history entry into a dictionary, with the text
+       to show for it under 'text'."""
+    row = rows[0]
+    date = row.Date[:19]
+    if kind == "purchase":
+        sellers = [(r.Seller, r.ProfitSplit) for r in rows]
+        return dict(kind=kind, date=row.Date, item=row.ItemName,
+                    count=row.Count, price_each=row.PriceEach, tax=row.Tax,
+                    buyer=row.Buyer, sellers=sellers,
+                    text="%s: %ix %s at $%s each; %s sold to %s." %
+                         (date, row.Count, row.ItemName,
+                          format_cents(row.PriceEach),
+                          ', '.join(seller for seller, _ in sellers),
+                          row.Buyer))
+    elif kind == "transfer":
+        return dict(kind=kind, date=row.Date, sender=row.Sender,
+                    receiver=row.Receiver, amount=row.Amount,
+                    text="%s: transfer $%s from %s to %s" %
+                         (date, format_cents(row.Amount), row.Sender,
+                          row.Receiver))
+    elif kind == "balance":
+        return dict(kind=kind, date=row.Date, amount=row.Amount,
+                    text="%s: %s $%s" %
+                         (date, "deposited" if row.Amount > 0 else "withdrew",
+                          format_cents(abs(row.Amount))))
+    elif kind == "stock":
+        return dict(kind=kind, date=row.Date, item=row.ItemName,
+                    old_count=row.OldCount, new_count=row.NewCount,
+                    price_each=row.PriceEach,
+                    text="%s: change stock from %i to %ix %s ($%s each)" %
+                         (date, row.OldCount, row.NewCount, row.ItemName,
+                          format_cents(row.PriceEach)))
+    else:
+        return dict(kind=kind, date=row.Date, item=row.ItemName,
+                    count=row.Count, price_each=row.PriceEach,
+                    text="%s: %ix %s expired" %
+                         (date, row.Count, row.ItemName))
+
+def select_history_page(conn, username, before=None,
+                        limit=history_page_size):
+    """Returns (entries, cursor): the newest entries of a user's history older
+       than the cursor before (from the newest if it is None), as a list of
+       dictionaries (see history_record), and the cursor to pass for the next
+       page, or None if there are no more entries. A purchase with several
+       sellers is one entry.
+
+       Every (table, user column) is read through its index newest first, and
+       these are merged, so a page costs the same however long the history
+       is."""
+    streams = [history_stream(conn, rank, column, username, before)
+               for rank, (kind, table, columns) in enumerate(history_sources)
+               for column in columns]
+    entries = [] # [key of the last row, kind, rows]
+    more = False
+    last_key = None
+    for key, row in heapq.merge(*streams, key=lambda pair: pair[0],
+                                reverse=True):
+        if key == last_key:
+            continue # a purchase from oneself is found by both columns
+        last_key = key
+        kind = history_sources[key[1]][0]
+        if (kind == "purchase" and entries and entries[-1][1] == kind and
+                same_purchase(entries[-1][2][0], row)):
+            # Rows of one purchase are written together, so the cursor of
+            # its last row skips the whole purchase.
+            entries[-1][0] = key
+            entries[-1][2].append(row)
+            continue
+        if len(entries) == limit:
+            more = True
+            break
+        entries.append([key, kind, [row]])
+    records = []
+    for key, kind, rows in entries:
+        if kind == "purchase" and rows[0].Buyer != username:
+            # Only the user's own share of a sale was found; the buyer's
+            # rows have every seller.
+            rows = Purchases.select(conn, "Buyer=? AND Date=? AND ItemName=?",
+                                    rows[0].Buyer, rows[0].Date,
+                                    rows[0].ItemName, order_by="rowid")
+        else:
+            rows.reverse() # in the order they were written
+        records.append(history_record(kind, rows))
+    cursor = list(entries[-1][0]) if more else None
+    return records, cursor
+
+def select_new_history(conn, username, since):
+    """The entries of a user's history dated since (a datetime) or later,
+       newest first; see select_history_page."""
+    since = str(since)
+    new_entries = []
+    cursor = None
+    while True:
+        entries, cursor = select_history_page(conn, username, cursor)
+        for entry in entries:
+            if entry['date'] < since:
+                return new_entries
+            new_entries.append(entry)
+        if cursor is None:
+            return new_entries
+
+def select_write_result(conn, version, username, date):
+    """What a write action returns, called in its transaction once it has
+       made its changes: what changed since the version it started at (see
+       select_changes), under 'user' username's own row, for their new
+       balance, and under 'history' the new entries in username's history
+       from date on (None and none if username is None). Other users are only
+       named. Pages apply this in place instead of loading everything again."""
+    result = select_changes(conn, version)
+    if username is None:
+        result['user'] = None
+        result['history'] = []
+    else:
+        result['user'] = Users.select_one(conn, "Name=?", username)
+        result['history'] = select_new_history(conn, username, date)
+    return result
+
+def get_history(username, before=None, limit=history_page_size):
+    """The next page of a user's history; see select_history_page."""
+    if not 1 <= limit <= max_history_page_size:
+        raise ValueError("A page of history holds 1 to %i entries, not %r" %
+                         (max_history_page_size, limit))
+    with DBConnection(readonly=True) as conn:
+        return select_history_page(conn, username, before, limit)
+
+def get_user_transactions(username):
+    """Returns all transactions associated with a username."""
+    with DBConnection(readonly=True) as conn:
+        return select_user_transactions(conn, username)
+
+def transfer_funds(sender, receiver, amount):
+    """Transfers any nonzero amount of funds from one user to another.
+       Returns what changed, for the sender (see select_write_result)."""
+    amount = cents(amount)
+    assert amount > 0
+    date = datetime.datetime.now()
+    with DBConnection() as conn:
+        version = change_version(conn)
+        adjust_balance(conn, date, sender, -amount, 'transfer')
+        adjust_balance(conn, date, receiver, amount, 'transfer')
+        Transfers.insert(conn, date, sender, receiver, amount)
+        return select_write_result(conn, version, sender, date)
+
+def donate(amount):
+    """Records an anonymous donation of cash. Returns True if successful."""
+    amount = cents(amount)
+    assert amount > 0
+    date = datetime.datetime.now()
+    with DBConnection() as conn:
+        Donations.insert(conn, date, amount)
+    return True
+
+def get_total_cash():
+    """The expected amount of cash in Limbo (in cents) is the sum of all user
+       balances and all donations."""
+    with DBConnection(readonly=True) as conn:
+        return (Users.sum(conn, "Balance", None) +
+                Donations.sum(conn, "Amount", None))
+
+def record_balance_change(conn, date, username, amount):
+    """Deposits or withdraws a nonzero amount within a transaction."""
+    adjust_balance(conn, date, username, amount, 'balance')
+    BalanceChanges.insert(conn, date, username, amount)
+
+def change_balance(username, amount):
+    """Deposit or withdraw some amount. Returns what changed (see
+       select_write_result)."""
+    amount = cents(amount)
+    date = datetime.datetime.now()
+    with DBConnection() as conn:
+        version = change_version(conn)
+        if amount != 0:
+            record_balance_change(conn, date, username, amount)
+        return select_write_result(conn, version, username, date)
+
+class Download():
+    """The result of an action which is sent as a file, as it is produced,
+       instead of being encoded in the request's wire format. chunks is an
+       iterable of strings, which is only read while the response is sent."""
+    def __init__(self, content_type, filename, chunks):
+        self.content_type = content_type
+        self.filename = filename
+        self.chunks = chunks
+        self.action = None # set by run_action()
+
+    def __iter__(self):
+        """Yields the body as bytes. Sending it is measured as the request."""
+        with metrics.measure(self.action) as request:
+            for chunk in self.chunks:
+                data = chunk.encode('utf-8')
+                request.response_bytes += len(data)
+                yield data
+
+# The columns of a history CSV: Kind, then every column of the history tables
+# once. Rows leave the columns their table doesn't have empty.
+csv_columns = ['Kind'] + list(dict.fromkeys(
+    name for kind, table, columns in history_sources
+    for name in table.fieldnames))
+# SQL expressions formatting amounts of money like format_cents(), and basis
+# points as fractions, so that rows go from sqlite to the CSV writer without
+# passing through python code one at a time. (A double is exact enough for
+# any integer number of cents or basis points to round back correctly.)
+csv_formats = {
+    "PriceEach":   "printf('%.2f', {0}/100.0)",
+    "Amount":      "printf('%.2f', {0}/100.0)",
+    "ProfitSplit": "printf('%.4f', {0}/10000.0)",
+    "Tax":         "printf('%.4f', {0}/10000.0)",
+}
+# Rows are written out in chunks of this many.
+csv_chunk_rows = 1000
+
+def history_csv(conn, username=None, start=None, end=None, kinds=None):
+    """Yields the history as CSV text, a chunk at a time, so that memory use
+       doesn't grow with the history. Only rows naming the user (everyone's if
+       None), dated from start up to but excluding end (dates such as
+       '2015-01-31'), and of the given kinds of history_sources (all if None)
+       are included. A user's rows of each table are ordered by date, and the
+       whole table's in the order they were written."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(csv_columns)
+    for kind, table, columns in history_sources:
+        if kinds is not None and kind not in kinds:
+            continue
+        conditions = []
+        dates = []
+        if start is not None:
+            conditions.append('Date>=?')
+            dates.append(start)
+        if end is not None:
+            conditions.append('Date<?')
+            dates.append(end)
+        what = ', '.join(["'%s'" % kind] +
+                         [csv_formats.get(name, '{0}').format(name)
+                          if name in table.fieldnames else "NULL"
+                          for name in csv_columns[1:]])
+        if username is None:
+            query = table.query(what, ' AND '.join(conditions) or None,
+                                order_by="rowid")
+            args = dates
+        else:
+            # The (column, Date) index of each column naming the user gives
+            # its rows by date, and sqlite merges them as they are read
+            # instead of sorting them all first. A row naming the user in
+            # several columns (a purchase from oneself) is taken once.
+            selects = []
+            args = []
+            for i, column in enumerate(columns):
+                where = (["%s=?" % column] +
+                         ["%s IS NOT ?" % other for other in columns[:i]] +
+                         conditions)
+                selects.append("SELECT rowid AS RowId, * FROM %s WHERE %s" %
+                               (table.name, ' AND '.join(where)))
+                args += [username] * (i + 1) + dates
+            query = "SELECT %s FROM (%s ORDER BY Date, RowId)" % (
+                what, ' UNION ALL '.join(selects))
+        rows = conn.execute(query, args)
+        while True:
+            chunk = rows.fetchmany(csv_chunk_rows)
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def generate_transactions_csv(username, start=None, end=None, kinds=None):
+    """A user's history as a CSV file download; see history_csv."""
+    def chunks():
+        with DBConnection(readonly=True) as conn:
+            yield from history_csv(conn, username, start, end, kinds)
+    filename = 'limbo4-%s.csv' % re.sub(r'[^A-Za-z0-9_.-]', '_', username)
+    return Download('text/csv; charset=utf-8', filename, chunks())
+
+def get_metrics(hours=24):
+    """Request counts and latency percentiles for each action served in the
+       last few hours, to find the slow ones. See Metrics.summary()."""
+    since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+    return metrics.summary(since)
+
+# These are the allowed actions of client requests.
+actions = {
+    "add_user":     add_user,
+    "usernames":    get_usernames,
+    "username":     get_username,
+    "store_info":   get_store_info,
+    "stock":        get_stock,
+    "changes_since": get_changes_since,
+    "search":       search_items,
+    "similar_items": get_similar_items,
+    "add_item":     add_item,
+    "addremove":    addremove_item,
+    "item_info":    get_item_info,
+    "checkout":     checkout,
+    "checkout_cart": checkout_cart,
+    "transactions": get_user_transactions,
+    "history":      get_history,
+    "transfer":     transfer_funds,
+    "donate":       donate,
+    "cash":         get_total_cash,
+    "balance":      change_balance,
+    "transactions.csv": generate_transactions_csv,
+    "metrics":      get_metrics,
+    # remove the following line in production
+    #"delete_test_database": delete_test_database,
+}
+
+# Amounts of money and fractions may be sent as strings ('1.25') or numbers; see
+# cents().
+money = (str, int, float)
+
+# The type every argument of an action must have once decoded.
+argument_types = {
+    "username":             str,
+    "email":                str,
+    "uid":                  int,
+    "itemname":             str,
+    "sellers":              dict,
+    "count":                int,
+    "price_each":           money,
+    "tax":                  money,
+    "expiry_time_in_weeks": int,
+    "description":          str,
+    "count_to_add":         int,
+    "buyername":            str,
+    "cart":                 dict,
+    "payment":              money,
+    "sender":               str,
+    "receiver":             str,
+    "amount":               money,
+    "hours":                (int, float),
+    "version":              int,
+    "before":               (list, tuple, type(None)),
+    "limit":                int,
+    "start":                (str, type(None)),
+    "end":                  (str, type(None)),
+    "kinds":                (list, tuple, type(None)),
+    "query":                str,
+}
+
+def is_cart(cart):
+    """Whether a cart maps item names to positive whole counts."""
+    return all(isinstance(itemname, str) and type(count) is int and count > 0
+               for itemname, count in cart.items())
+
+# Checks on the value of some arguments, beyond their type.
+argument_checks = {
+    "cart": is_cart,
+}
+
+def encode_repr(result):
+    return '%s\n' % (result,)
+
+def encode_json(result):
+    return json.dumps(result, separators=(',', ':')) + '\n'
+
+# How arguments are decoded and results encoded, and the content type of the
+# response. Clients choose with the "format" argument; requests without one get
+# python literals, with the same results as JSON ones.
+wire_formats = {
+    "repr": (ast.literal_eval, encode_repr, 'text/html; charset=utf-8'),
+    "json": (json.loads,       encode_json, 'application/json; charset=utf-8'),
+}
+
+def wire_format(form):
+    """Returns (decode, encode, content_type) for the format of a request."""
+    return wire_formats.get(form.get("format"), wire_formats["repr"])
+
+def decode_argument(argname, text, decode):
+    value = decode(text)
+    if not isinstance(value, argument_types[argname]):
+        raise TypeError("Argument %s has the wrong type: %r" % (argname, value))
+    check = argument_checks.get(argname)
+    if check is not None and not check(value):
+        raise ValueError("Argument %s has an invalid value: %r" %
+                         (argname, value))
+    return value
+
+# For the actions which only read, the tables their results depend on. Their
+# responses carry an ETag made from the versions of these tables, so that a
+# client which already has the current response can be told so ("304 Not
+# Modified") without the action being run.
+history_tables = tuple(table for kind, table, columns in history_sources)
+cacheable_actions = {
+    "usernames":    (UserNames,),
+    "username":     (Users,),
+    "store_info":   (Users, Items, Sellers) + history_tables,
+    "stock":        (Items, Sellers),
+    "changes_since": (Users, Items, Sellers),
+    "search":       (Items,),
+    "similar_items": (Items,),
+    "item_info":    (Items,),
+    "transactions": history_tables,
+    "history":      history_tables,
+    "cash":         (Users, Donations),
+}
+
+def response_etag(action, form):
+    """The ETag of the response to a request, or None if the action's results
+       aren't cacheable. Only the table versions are read."""
+    if action not in cacheable_actions:
+        return None
+    with DBConnection(readonly=True) as conn:
+        versions = table_versions(conn, cacheable_actions[action])
+    key = repr((action, sorted(form.items()), versions))
+    return '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def run_action(action, form):
+    """Runs the requested action. form maps argument names to the strings sent
+       by the client, encoded as form["format"] says. Returns the text to send
+       back, or '' if no valid action is provided. Actions which produce a
+       file return a Download instead."""
+    if action not in actions:
+        return ''
+    function = actions[action]
+    decode, encode, content_type = wire_format(form)
+    with metrics.measure(action) as request:
+        # What is about to happen uses CPython-specific code to find the
+        # arguments in the function and assign them based on name. Arguments
+        # the client didn't send fall back on their defaults.
+        argnames = function.__code__.co_varnames[:function.__code__.co_argcount]
+        arguments_to_apply = {}
+        for argname in argnames:
+            if argname in form:
+                arguments_to_apply[argname] = decode_argument(
+                    argname, form[argname], decode)
+        result = function(**arguments_to_apply)
+        if isinstance(result, Download):
+            # Measured while it is sent instead.
+            request.discard()
+            result.action = action
+            return result
+        response = encode(result)
+        request.response_bytes = len(response.encode('utf-8'))
+    return response
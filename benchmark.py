@@ -0,0 +1,550 @@
+#!/usr/bin/python3
+# Benchmarks for Limbo4. These always run against a scratch database in a
+# temporary directory, never against data/limbo4.db.
+#
+#     ./benchmark.py cgi [-n REQUESTS]
+#         p50/p99 latency of store_info and checkout, served by the cgi script
+#         (one python process per request) and by the long-running server in
+#         wsgi.py.
+#
+#     ./benchmark.py locks [--readers N] [--writers N] [--seconds S] [--legacy]
+#         Lock waits while several kiosks load the store page and check out at
+#         the same time. --legacy uses the old exclusive transactions without
+#         WAL, for comparison.
+#
+#     ./benchmark.py store_info [--items N] [--users N] [-n REQUESTS]
+#         The store_info action against the six separate queries (each in its
+#         own transaction) it used to make, on a large store.
+#
+#     ./benchmark.py reverify [--purchases N] [--users N]
+#         reverify.py's grouped queries against the old per-user queries, on a
+#         store with a long purchase history.
+#
+#     ./benchmark.py conditional [--users N]
+#         store_info and usernames over http, fully and as 304 Not Modified.
+#
+#     ./benchmark.py history [--purchases N] [--users N]
+#         A heavy user's whole history against a page of it.
+#
+#     ./benchmark.py protocol [--users N]
+#         Size and parse time of a long store_info response as python literals
+#         and as JSON.
+#
+#     ./benchmark.py suite [--scales small,medium,large] [-o FILE]
+#                          [--compare OLD_FILE]
+#         Times every action of the server, reverify.py and expiration.py on
+#         stores made by gendata.py at several scales, and writes the results
+#         as JSON, so that runs on different commits can be compared.
+import os
+import sys
+import time
+import json
+import platform
+import datetime
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode
+
+path_to_bench = os.path.dirname(os.path.abspath(__file__))
+scratch_dir = tempfile.mkdtemp(prefix='limbo4-bench-')
+os.environ['LIMBO_DATABASE'] = os.path.join(scratch_dir, 'limbo4.db')
+sys.path.insert(0, path_to_bench)
+
+import server
+import actions
+import wsgi
+import reverify
+import expiration
+import gendata
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(samples)
+    rank = max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def report(name, samples):
+    print("%-24s n=%-5i p50 %8.2f ms   p99 %8.2f ms" %
+          (name, len(samples), percentile(samples, 50) * 1000,
+           percentile(samples, 99) * 1000))
+
+def populate(users=20, items=50):
+    """Fills the scratch database with some users, each selling a few items
+       with plenty in stock, and a little purchase history."""
+    actions.initialize_test_database()
+    for i in range(users):
+        actions.add_user('user%i' % i, 'user%i@example.com' % i, 1000000 + i)
+    for i in range(items):
+        actions.add_item('item%i' % i, {'user%i' % (i % users): None},
+                         10 ** 6, '1.25', '0.05', 52,
+                         'A description of item %i' % i)
+    for i in range(users):
+        actions.checkout('item%i' % i, 'user%i' % ((i + 1) % users), 1)
+        actions.change_balance('user%i' % i, '5.00')
+
+def cgi_request(form):
+    """Runs the cgi script once, the way a web server would."""
+    body = urlencode(form).encode('utf-8')
+    env = dict(os.environ,
+               REQUEST_METHOD='POST',
+               CONTENT_TYPE='application/x-www-form-urlencoded',
+               CONTENT_LENGTH=str(len(body)),
+               QUERY_STRING='',
+               SERVER_NAME='localhost',
+               SERVER_PORT='80',
+               SERVER_PROTOCOL='HTTP/1.1',
+               GATEWAY_INTERFACE='CGI/1.1')
+    result = subprocess.run([sys.executable, 'limbo-cgi.py'], input=body,
+                            env=env, stdout=subprocess.PIPE, check=True,
+                            cwd=os.path.join(path_to_bench, 'cgi-bin'))
+    return result.stdout
+
+def start_server():
+    """Starts wsgi.py's server on a free port in a background thread."""
+    httpd = wsgi.serve('127.0.0.1', 0, quiet=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+def http_request(address, form, headers={}):
+    body = urlencode(form)
+    conn = http.client.HTTPConnection(*address)
+    conn.request('POST', '/cgi-bin/limbo-cgi.py', body,
+                 dict(headers,
+                      **{'Content-Type': 'application/x-www-form-urlencoded'}))
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response, body
+
+def time_requests(send, form, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        send(form)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def bench_cgi(n):
+    populate()
+    requests = [
+        ("store_info", dict(action='store_info', username=repr('user1'))),
+        ("checkout", dict(action='checkout', itemname=repr('item3'),
+                          buyername=repr('user1'), count='1')),
+    ]
+    httpd = start_server()
+    try:
+        for name, form in requests:
+            report("%s (cgi)" % name, time_requests(cgi_request, form, n))
+            report("%s (wsgi)" % name,
+                   time_requests(lambda form: http_request(httpd.server_address,
+                                                           form), form, n))
+    finally:
+        httpd.shutdown()
+
+def bench_conditional(users, n):
+    """Requests with and without the ETag of the previous response."""
+    gendata.generate(users=users, items=1000, purchases=50 * users)
+    httpd = start_server()
+    try:
+        for action, arguments in (('store_info',
+                                   dict(username=heaviest_user())),
+                                  ('usernames', {})):
+            form = encode_form(arguments, 'json')
+            form['action'] = action
+            response, body = http_request(httpd.server_address, form)
+            etag = response.getheader('ETag')
+            report("%s (200)" % action, time_requests(
+                lambda form: http_request(httpd.server_address, form),
+                form, n))
+            report("%s (304)" % action, time_requests(
+                lambda form: http_request(httpd.server_address, form,
+                                          {'If-None-Match': etag}),
+                form, n))
+            print("%-24s %i bytes saved" % ('', len(body)))
+    finally:
+        httpd.shutdown()
+
+def bench_locks(readers, writers, seconds, legacy):
+    if legacy:
+        server.pool.journal_mode = 'DELETE'
+        server.pool.max_idle = 0
+        server.DBConnection.read_begin = 'BEGIN EXCLUSIVE'
+        server.DBConnection.write_begin = 'BEGIN EXCLUSIVE'
+    populate()
+    server.lock_stats.clear()
+    deadline = time.perf_counter() + seconds
+    done = {'store_info': 0, 'checkout': 0, 'failed': 0}
+    done_lock = threading.Lock()
+
+    def work(name, action, *args):
+        while time.perf_counter() < deadline:
+            try:
+                action(*args)
+                outcome = name
+            except server.sql.OperationalError:
+                outcome = 'failed'
+            with done_lock:
+                done[outcome] += 1
+
+    threads = [threading.Thread(target=work, args=('store_info',
+                                                   actions.get_store_info,
+                                                   'user%i' % i))
+               for i in range(readers)]
+    threads += [threading.Thread(target=work, args=('checkout',
+                                                    actions.checkout,
+                                                    'item%i' % i,
+                                                    'user%i' % i, 1))
+                for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("%s, %i readers, %i writers, %.1f s" %
+          ('legacy' if legacy else 'pooled/WAL', readers, writers, seconds))
+    for name, count in done.items():
+        print("  %-12s %8i  (%.1f/s)" % (name, count, count / seconds))
+    for kind, stats in server.lock_stats.summary().items():
+        print("  %-5s lock wait: n=%-6i mean %7.2f ms  p50 %7.2f ms  "
+              "p99 %7.2f ms  max %7.2f ms" %
+              (kind, stats['count'], stats['mean'] * 1000, stats['p50'] * 1000,
+               stats['p99'] * 1000, stats['max'] * 1000))
+
+def legacy_store_info(username):
+    """store_info as it used to be: six separate transactions."""
+    return (actions.get_username(username), actions.get_all_stock(),
+            actions.get_usernames(), actions.get_user_stock(username),
+            actions.get_all_sellers(), actions.get_user_transactions(username))
+
+def bench_store_info(items, users, n):
+    data = gendata.generate(users=users, items=items, purchases=20 * users,
+                            transfers=2 * users, balance_changes=2 * users)
+    username = data['usernames'][1]
+    for name, function in (("store_info (separate)", legacy_store_info),
+                           ("store_info", actions.get_store_info)):
+        server.lock_stats.clear()
+        samples = time_requests(function, username, n)
+        report(name, samples)
+        transactions = sum(stats['count'] for stats in
+                           server.lock_stats.summary().values())
+        print("%-24s %.1f transactions per request" % ('', transactions / n))
+
+def legacy_expected_balances(conn):
+    """reverify.py as it used to be: five queries per user, summed in
+       python."""
+    balances = {}
+    for user in server.Users.select(conn, None):
+        purchases = server.Purchases.select(
+            conn, "Buyer = ? group by Date, ItemName", user.Name)
+        sales = server.Purchases.select(conn, "Seller = ?", user.Name)
+        transfers = server.Transfers.select(conn, "Sender = ?", user.Name)
+        received = server.Transfers.select(conn, "Receiver = ?", user.Name)
+        changes = server.BalanceChanges.select(conn, "User = ?", user.Name)
+        balances[user.Name] = (
+            sum(change.Amount for change in changes)
+            + sum(server.share(sale.PriceEach * sale.Count, sale.ProfitSplit)
+                  for sale in sales)
+            + sum(receival.Amount for receival in received)
+            - sum(purchase.PriceEach * purchase.Count
+                  for purchase in purchases)
+            - sum(transfer.Amount for transfer in transfers))
+    return balances
+
+def bench_reverify(purchases, users):
+    start = time.perf_counter()
+    gendata.generate(users=users, items=1000, purchases=purchases,
+                     transfers=purchases // 10, balance_changes=purchases // 10)
+    print("generated %i purchases in %.1f s" %
+          (purchases, time.perf_counter() - start))
+    results = []
+    for name, function in (("reverify (per user)", legacy_expected_balances),
+                           ("reverify (grouped)", reverify.expected_balances)):
+        with server.DBConnection(readonly=True) as conn:
+            start = time.perf_counter()
+            results.append(function(conn))
+            print("%-24s %8.2f s" % (name, time.perf_counter() - start))
+    assert results[0] == results[1]
+
+# Volumes of data for the benchmark suite; see gendata.py.
+scales = {
+    'small':  dict(users=100, items=200, purchases=10000, transfers=1000,
+                   balance_changes=2000, restocks=500, expiries=100),
+    'medium': dict(users=1000, items=1000, purchases=100000, transfers=10000,
+                   balance_changes=20000, restocks=5000, expiries=1000),
+    'large':  dict(users=10000, items=2000, purchases=1000000,
+                   transfers=100000, balance_changes=200000, restocks=20000,
+                   expiries=2000),
+}
+
+def sample_arguments(data):
+    """Arguments for every action, as a client would send them before they are
+       encoded. Each is a function of the request number, so that repeated
+       write actions don't collide or run out of stock."""
+    users = data['usernames']
+    items = data['items']
+    user = lambda i: users[i % len(users)]
+    item = lambda i: items[i % len(items)]
+    return {
+        "add_user": lambda i: dict(username='Bench%i' % i,
+                                   email='bench@example.com', uid=1234567),
+        "usernames": lambda i: {},
+        "username": lambda i: dict(username=user(i)),
+        "store_info": lambda i: dict(username=user(i)),
+        "stock": lambda i: {},
+        # Whatever the benchmark itself changed since the store was made.
+        "changes_since": lambda i: dict(version=data['version']),
+        # As it is typed, a few letters at a time.
+        "search": lambda i: dict(query=item(i)[:3 + i % 8]),
+        # A new item's name as it is typed, like that of one in stock.
+        "similar_items": lambda i: dict(itemname=item(i)[:4 + i % 8].lower()),
+        "add_item": lambda i: dict(itemname='Bench item %i' % i,
+                                   sellers={user(i): None}, count=10,
+                                   price_each='1.25', tax='0.05',
+                                   expiry_time_in_weeks=52,
+                                   description='A benchmark item',
+                                   username=user(i)),
+        "addremove": lambda i: dict(itemname=item(i), count_to_add=1,
+                                    username=user(i)),
+        "item_info": lambda i: dict(itemname=item(i)),
+        "checkout": lambda i: dict(itemname=item(i), buyername=user(i),
+                                   count=1),
+        "checkout_cart": lambda i: dict(
+            buyername=user(i), payment='5.00',
+            cart=dict((item(3 * i + j), 1) for j in range(3))),
+        "transactions": lambda i: dict(username=user(i)),
+        "history": lambda i: dict(username=user(i)),
+        "transfer": lambda i: dict(sender=user(i), receiver=user(i + 1),
+                                   amount='1.00'),
+        "donate": lambda i: dict(amount='1.00'),
+        "cash": lambda i: {},
+        "balance": lambda i: dict(username=user(i), amount='2.00'),
+        "transactions.csv": lambda i: dict(username=user(i)),
+        "metrics": lambda i: {},
+    }
+
+def encode_form(arguments, format):
+    """The form a client using the given wire format would send."""
+    if format == 'json':
+        form = dict((name, json.dumps(value))
+                    for name, value in arguments.items())
+    else:
+        form = dict((name, repr(value)) for name, value in arguments.items())
+    form['format'] = format
+    return form
+
+class Rollback(Exception):
+    pass
+
+def run_expiration():
+    """expiration.py for real, but rolled back afterwards."""
+    try:
+        with server.DBConnection() as conn:
+            expiration.expire_items(conn, datetime.datetime.now(),
+                                    dry_run=False)
+            raise Rollback()
+    except Rollback:
+        pass
+
+def run_reverify():
+    with server.DBConnection(readonly=True) as conn:
+        reverify.find_discrepancies(conn)
+
+def summarize(samples):
+    return dict(n=len(samples),
+                mean_ms=sum(samples) / len(samples) * 1000,
+                p50_ms=percentile(samples, 50) * 1000,
+                p90_ms=percentile(samples, 90) * 1000,
+                p99_ms=percentile(samples, 99) * 1000,
+                max_ms=max(samples) * 1000)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path_to_bench,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def heaviest_user():
+    """The user with the longest purchase history."""
+    with server.DBConnection(readonly=True) as conn:
+        return conn.execute("SELECT Buyer FROM Purchases GROUP BY Buyer "
+                            "ORDER BY COUNT(*) DESC LIMIT 1").fetchone()[0]
+
+def bench_history(purchases, users, n):
+    gendata.generate(users=users, items=1000, purchases=purchases,
+                     transfers=purchases // 10, balance_changes=purchases // 10)
+    username = heaviest_user()
+    report("whole history", time_requests(actions.get_user_transactions,
+                                          username, n))
+    report("first page", time_requests(actions.get_history, username, n))
+    entries, cursor = actions.get_history(username)
+    for i in range(20):
+        entries, cursor = actions.get_history(username, cursor)
+    report("21st page", time_requests(
+        lambda cursor: actions.get_history(username, cursor), cursor, n))
+
+def bench_protocol(users, n):
+    """Size of a store_info response and time to encode and parse it in each
+       wire format. The browser parses JSON natively; python literals were
+       eval()ed by Brython, which is much slower than literal_eval here."""
+    gendata.generate(users=users, items=1000, purchases=50 * users,
+                     transfers=5 * users, balance_changes=5 * users)
+    username = heaviest_user()
+    for format in ('repr', 'json'):
+        decode, encode, content_type = actions.wire_format(dict(format=format))
+        form = encode_form(dict(username=username), format)
+        response = actions.run_action('store_info', form)
+        samples = time_requests(lambda form: actions.run_action('store_info',
+                                                                form), form, n)
+        report("store_info (%s)" % format, samples)
+        samples = time_requests(decode, response, n)
+        report("  parse (%s)" % format, samples)
+        print("%-24s %i bytes" % ('', len(response.encode('utf-8'))))
+
+def bench_suite(scale_names, n, script_repeats, format):
+    """Times every action, reverify.py and expiration.py at each scale, and
+       returns the results as a dictionary (see --output)."""
+    results = dict(commit=git_commit(),
+                   date=str(datetime.datetime.now()),
+                   python=platform.python_version(),
+                   sqlite=server.sql.sqlite_version,
+                   requests_per_action=n,
+                   format=format,
+                   scales={})
+    for scale in scale_names:
+        server.sql_database = os.path.join(scratch_dir, '%s.db' % scale)
+        start = time.perf_counter()
+        data = gendata.generate(**scales[scale])
+        generate_seconds = time.perf_counter() - start
+        print("%s: generated in %.1f s" % (scale, generate_seconds))
+        arguments = sample_arguments(data)
+        timings = {}
+        for action in actions.actions:
+            if action not in arguments:
+                print("  no sample arguments for %s, skipped" % action,
+                      file=sys.stderr)
+                continue
+            samples = []
+            for i in range(n):
+                form = encode_form(arguments[action](i), format)
+                start = time.perf_counter()
+                response = actions.run_action(action, form)
+                if isinstance(response, actions.Download):
+                    for chunk in response:
+                        pass
+                samples.append(time.perf_counter() - start)
+            timings[action] = summarize(samples)
+        # The write actions above, checkout_cart's carts of three items among
+        # them, must leave every balance as its history says.
+        with server.DBConnection(readonly=True) as conn:
+            assert reverify.find_discrepancies(conn) == {}
+        for name, function in (("reverify.py", run_reverify),
+                               ("expiration.py", run_expiration)):
+            samples = []
+            for i in range(script_repeats):
+                start = time.perf_counter()
+                function()
+                samples.append(time.perf_counter() - start)
+            timings[name] = summarize(samples)
+        for name, timing in timings.items():
+            print("  %-20s p50 %9.2f ms   p99 %9.2f ms" %
+                  (name, timing['p50_ms'], timing['p99_ms']))
+        results['scales'][scale] = dict(volumes=dict(gendata.defaults,
+                                                     **scales[scale]),
+                                        generate_seconds=generate_seconds,
+                                        timings=timings)
+        server.pool.close_all()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(server.sql_database + suffix):
+                os.remove(server.sql_database + suffix)
+    return results
+
+def compare(old, new):
+    """Prints the change in p50 of everything timed in both results."""
+    print("p50 compared with commit %s:" % old.get('commit'))
+    for scale, result in new['scales'].items():
+        old_timings = old['scales'].get(scale, {}).get('timings', {})
+        for name, timing in result['timings'].items():
+            if name in old_timings:
+                before = old_timings[name]['p50_ms']
+                print("  %-7s %-20s %9.2f ms -> %9.2f ms  (%+.0f%%)" %
+                      (scale, name, before, timing['p50_ms'],
+                       (timing['p50_ms'] / before - 1) * 100 if before else 0))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Limbo4 benchmarks.")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparser = subparsers.add_parser('cgi', help="cgi script vs. wsgi.py")
+    subparser.add_argument('-n', type=int, default=100,
+                           help="requests per action and mode")
+    subparser = subparsers.add_parser('locks', help="concurrent lock waits")
+    subparser.add_argument('--readers', type=int, default=4)
+    subparser.add_argument('--writers', type=int, default=2)
+    subparser.add_argument('--seconds', type=float, default=5.0)
+    subparser.add_argument('--legacy', action='store_true',
+                           help="exclusive transactions, no WAL, no pooling")
+    subparser = subparsers.add_parser('store_info',
+                                      help="store_info on a large store")
+    subparser.add_argument('--items', type=int, default=1000)
+    subparser.add_argument('--users', type=int, default=10000)
+    subparser.add_argument('-n', type=int, default=100)
+    subparser = subparsers.add_parser('reverify',
+                                      help="reverify.py on a long history")
+    subparser.add_argument('--purchases', type=int, default=1000000)
+    subparser.add_argument('--users', type=int, default=1000)
+    subparser = subparsers.add_parser('conditional',
+                                      help="responses with and without 304")
+    subparser.add_argument('--users', type=int, default=1000)
+    subparser.add_argument('-n', type=int, default=50)
+    subparser = subparsers.add_parser('history',
+                                      help="whole history vs one page")
+    subparser.add_argument('--purchases', type=int, default=200000)
+    subparser.add_argument('--users', type=int, default=100)
+    subparser.add_argument('-n', type=int, default=20)
+    subparser = subparsers.add_parser('protocol',
+                                      help="repr vs JSON responses")
+    subparser.add_argument('--users', type=int, default=100)
+    subparser.add_argument('-n', type=int, default=20)
+    subparser = subparsers.add_parser('suite',
+                                      help="every action at several scales")
+    subparser.add_argument('--scales', default='small,medium',
+                           help="comma-separated, from %s" %
+                                ', '.join(sorted(scales)))
+    subparser.add_argument('-n', type=int, default=50,
+                           help="requests per action")
+    subparser.add_argument('--script-repeats', type=int, default=3)
+    subparser.add_argument('--format', choices=sorted(actions.wire_formats),
+                           default='json', help="wire format of requests")
+    subparser.add_argument('-o', '--output', default='benchmark.json',
+                           help="where to write the results as JSON")
+    subparser.add_argument('--compare', metavar='OLD_JSON',
+                           help="results of an earlier run to compare with")
+    args = parser.parse_args()
+    if args.benchmark == 'cgi':
+        bench_cgi(args.n)
+    elif args.benchmark == 'locks':
+        bench_locks(args.readers, args.writers, args.seconds, args.legacy)
+    elif args.benchmark == 'store_info':
+        bench_store_info(args.items, args.users, args.n)
+    elif args.benchmark == 'reverify':
+        bench_reverify(args.purchases, args.users)
+    elif args.benchmark == 'conditional':
+        bench_conditional(args.users, args.n)
+    elif args.benchmark == 'history':
+        bench_history(args.purchases, args.users, args.n)
+    elif args.benchmark == 'protocol':
+        bench_protocol(args.users, args.n)
+    elif args.benchmark == 'suite':
+        results = bench_suite(args.scales.split(','), args.n,
+                              args.script_repeats, args.format)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), results)
+    else:
+        parser.print_help()
@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+# Compiles the pages' python to javascript ahead of time, so that browsers don't
+# have to compile store.py, limbo.py and the rest before showing anything, nor
+# fetch the modules they import one at a time.
+#
+#     ./build.py            compile, and make the pages load the compiled files
+#     ./build.py --clean    make the pages compile in the browser again
+#
+# Compiling is done by brython.js's own compiler, run with node. For each page,
+# the imports of its script are followed to find every module it can need, from
+# Lib/, libs/ or Lib/site-packages; only these go into the page's bundle,
+# build/<page>.<hash>.js, together with the compiled script. The bundle is named
+# after a hash of its contents, so that the web server can let browsers cache it
+# for good (see the README), and is also written gzipped, next to it, for the
+# web server to send as it is.
+#
+# In each page, the python script between
+#     <!-- build.py -->  and  <!-- end build.py -->
+# (in a file or inline) is kept, but with a type browsers ignore, and followed
+# by the bundle; --clean gives it its type back and removes the bundle.
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import subprocess
+
+root = os.path.dirname(os.path.abspath(__file__))
+build_dir = 'build'
+
+pages = ['index.html', 'store.html', 'create_account.html']
+
+# The type of a page's script once it is compiled; brython() skips it.
+compiled_type = 'text/python-compiled'
+
+block_re = re.compile(r'(<!-- build\.py -->\n)(.*?)(<!-- end build\.py -->)',
+                      re.S)
+script_re = re.compile(r'<script type="text/python(?:-compiled)?"'
+                       r'(?: src="([^"]+)")?>(.*?)</script>', re.S)
+
+# Compiles modules with brython.js. Reads {"brython": path, "modules": [[name,
+# url, source], ...]} and writes {"stdlib": brython's table of standard
+# modules, "modules": {name: javascript}}, or {"error": message}. Each module is
+# compiled by a fresh copy of the compiler, with the same "random" numbers, so
+# that it comes out the same whatever else is compiled: the compiler numbers
+# its temporary variables as it goes.
+compiler_js = r'''
+var fs = require('fs')
+var job = JSON.parse(fs.readFileSync(0, 'utf8'))
+var brython_js = fs.readFileSync(job.brython, 'utf8')
+var write = process.stdout.write.bind(process.stdout)
+console.log = function(){} // the compiler's own chatter
+// Just enough of a browser for brython.js to start.
+global.window = global
+global.document = {getElementsByTagName: function(){return []}}
+global.navigator = {userLanguage: 'en', language: 'en'}
+window.location = {href: 'http://localhost/index.html'}
+function compiler(){
+    var seed = 1
+    Math.random = function(){
+        seed = (seed * 16807) % 2147483647
+        return seed / 2147483647
+    }
+    delete global.__BRYTHON__
+    ;(0, eval)(brython_js)
+    brython({debug: job.debug})
+    return __BRYTHON__
+}
+// eval() and exec() need to know their module. Only the nodes at the top of
+// the module are told which it is, unless the compiler adds line numbers (as
+// in debug mode, which the pages use); the others are told here.
+function set_module(node, name){
+    if(node.module === undefined){node.module = name}
+    for(var i = 0; i < node.children.length; i++){
+        set_module(node.children[i], name)
+    }
+}
+var result = {stdlib: compiler().stdlib, modules: {}}
+for(var i = 0; i < job.modules.length; i++){
+    var name = job.modules[i][0], url = job.modules[i][1]
+    var $B = compiler()
+    $B.$py_module_path[name] = url
+    try{
+        var root = $B.py2js(job.modules[i][2], name)
+        set_module(root, name)
+        result.modules[name] = root.to_js()
+    }catch(err){
+        result = {error: url + ': ' + (err.__name__ || 'Error') + ': ' +
+                         (err.message || err) + '\n' + (err.info || '')}
+        break
+    }
+}
+write(JSON.stringify(result))
+'''
+
+# Runs the bundled modules instead of fetching and compiling them. brython()
+# still starts everything up; then the page's own compiled script is run, and
+# a bundled module is run the first time it is imported. Any other module (one
+# imported in a way build.py can't see) is found and compiled as usual.
+loader_js = r'''// Generated by build.py.
+;(function($B){
+var precompiled = $B.precompiled = $B.precompiled || {}
+
+function run(name){
+    var url = $B.brython_path + precompiled[name][0]
+    if(precompiled[name][3]){
+        // Written in javascript, like libs/*.js
+        var mod = precompiled[name][2]()
+        mod.__class__ = $B.$ModuleDict
+        mod.__name__ = name
+        mod.__file__ = url
+        mod.toString = function(){return "module " + name}
+        $B.imported[name] = $B.modules[name] = $B.vars[name] = mod
+        return
+    }
+    var mod = {__class__: $B.$ModuleDict}
+    $B.modules[name] = $B.imported[name] = mod
+    $B.$py_module_path[name] = url
+    $B.vars[name] = {}
+    precompiled[name][2]()
+    for(var attr in $B.vars[name]){mod[attr] = $B.vars[name][attr]}
+    mod.toString = function(){return "module " + name}
+    mod.__file__ = url
+    mod.__initializing__ = false
+    mod.$package = precompiled[name][1]
+    $B.imported[name] = $B.modules[name] = $B.vars[name] = mod
+}
+
+var $import = $B.$import
+$B.$import = function(mod_name, origin){
+    var elts = mod_name.split('.')
+    for(var i = 0; i < elts.length; i++){
+        var name = elts.slice(0, i + 1).join('.')
+        if($B.imported[name] === undefined &&
+                precompiled[name] !== undefined){
+            run(name)
+            if(i > 0){
+                $B.modules[elts.slice(0, i).join('.')][elts[i]] =
+                    $B.modules[name]
+            }
+        }
+    }
+    return $import(mod_name, origin)
+}
+
+var start = $B.brython
+window.brython = $B.brython = function(options){
+    start(options)
+    var main = $B.precompiled_main
+    if(main === undefined){return}
+    $B.$py_module_path['__main__'] = $B.script_dir + '/' + main[0]
+    $B.vars['__main__'] = {}
+    try{
+        main[1]()
+        var mod = $B.vars['__main__']
+        mod.__class__ = $B.$ModuleDict
+        mod.__name__ = '__main__'
+        mod.__file__ = $B.$py_module_path['__main__']
+        $B.imported['__main__'] = mod
+    }catch(err){
+        if(err.py_error === undefined){
+            err = $B.builtins.RuntimeError(err + '')
+        }
+        $B.builtins.getattr($B.stderr, 'write')(
+            err.__name__ + ': ' + err.message + '\n' + err.info)
+        throw err
+    }
+}
+})(__BRYTHON__)
+'''
+
+import_re = re.compile(r'__BRYTHON__\.\$import(_from)?\("([^"]+)"'
+                       r'(?:,\[([^\]]*)\])?')
+
+def compile_modules(modules, debug=0):
+    """Compiles [(name, url, source)] with brython.js. Returns (stdlib,
+       {name: javascript})."""
+    job = dict(brython=os.path.join(root, 'brython.js'), debug=debug,
+               modules=modules)
+    process = subprocess.run(['node', '-e', compiler_js], check=True,
+                             input=json.dumps(job).encode('utf-8'),
+                             stdout=subprocess.PIPE)
+    result = json.loads(process.stdout.decode('utf-8'))
+    if 'error' in result:
+        raise SystemExit("Can't compile %s" % result['error'])
+    return result['stdlib'], result['modules']
+
+def imports(javascript):
+    """The modules a compiled module imports when it is run, with the
+       submodules a "from package import name" may mean."""
+    names = []
+    for is_from, module, fromlist in import_re.findall(javascript):
+        module = module.replace('$$', '')
+        parts = module.split('.')
+        names += ['.'.join(parts[:i + 1]) for i in range(len(parts))]
+        if is_from:
+            names += ['%s.%s' % (module, name.strip('" ').replace('$$', ''))
+                      for name in fromlist.split(',') if name.strip('" ')]
+    return names
+
+def locate(name, stdlib):
+    """Where the browser finds a module, as (path, is_package), like
+       $B.$import does: the standard library, then Lib/site-packages, then next
+       to the pages. None if it doesn't exist."""
+    path = name.replace('.', '/')
+    if name in stdlib:
+        kind, is_package = (stdlib[name] + [False])[:2]
+        if kind != 'py':
+            return 'libs/%s.js' % path, False
+        return ('Lib/%s/__init__.py' % path if is_package else
+                'Lib/%s.py' % path), bool(is_package)
+    for folder in ('Lib/site-packages/', ''):
+        for candidate, is_package in ((path + '.py', False),
+                                      (path + '/__init__.py', True)):
+            if os.path.exists(os.path.join(root, folder + candidate)):
+                return folder + candidate, is_package
+    return None
+
+# Brython makes a generator function's code from its syntax tree each time it is
+# called, so the tree has to be there at run time: modules with generators are
+# bundled as python, and compiled in the browser when they are first imported.
+generator_marker = '__BRYTHON__.$BRgenerator('
+
+def compiled_in_browser(name, source):
+    """The javascript which compiles and runs a module in the browser."""
+    return 'eval(__BRYTHON__.py2js(%s, %s).to_js())' % (json.dumps(source),
+                                                        json.dumps(name))
+
+def read(path):
+    with open(os.path.join(root, path), encoding='utf-8') as f:
+        return f.read()
+
+def write(path, contents):
+    mode = 'wb' if isinstance(contents, bytes) else 'w'
+    with open(os.path.join(root, path), mode) as f:
+        f.write(contents)
+
+def page_script(page):
+    """Returns a page's python script as (the url it comes from, its source,
+       its tag as it is written in the page, with the python type)."""
+    block = block_re.search(read(page))
+    if block is None:
+        raise SystemExit("%s has no <!-- build.py --> markers" % page)
+    script = script_re.search(block.group(2))
+    if script is None:
+        raise SystemExit("%s has no python script between the markers" % page)
+    tag = script.group(0).replace(compiled_type, 'text/python', 1)
+    if script.group(1):
+        return script.group(1), read(script.group(1)), tag
+    return page, script.group(2), tag
+
+def compile_page(page):
+    """Compiles a page's script and finds every module it can import,
+       directly or not. Returns the script's javascript, and {name: (path,
+       is_package, javascript, is_js)} for the modules; the python ones are
+       compiled, and those written in javascript kept as they are."""
+    url, source, tag = page_script(page)
+    stdlib, found = compile_modules([('__main__', url, source)])
+    main = found['__main__']
+    modules = {}
+    def needed(javascript):
+        return sorted(set(name for name in imports(javascript)
+                          if name not in modules and
+                          locate(name, stdlib) is not None))
+    wanted = needed(main)
+    if generator_marker in main:
+        main = compiled_in_browser('__main__', source)
+    while wanted:
+        python = [(name, locate(name, stdlib)[0], read(locate(name, stdlib)[0]))
+                  for name in wanted
+                  if locate(name, stdlib)[0].endswith('.py')]
+        found = compile_modules(python)[1] if python else {}
+        for name in wanted:
+            path, is_package = locate(name, stdlib)
+            if name not in found:
+                modules[name] = (path, is_package, read(path), True)
+            elif generator_marker in found[name]:
+                modules[name] = (path, is_package,
+                                 compiled_in_browser(name, read(path)), False)
+            else:
+                modules[name] = (path, is_package, found[name], False)
+        wanted = sorted(set(new for name in wanted
+                            for new in needed(found.get(name,
+                                                        modules[name][2]))))
+    return main, modules
+
+def module_js(name, path, is_package, javascript, is_js=False):
+    if name == '__main__':
+        return ('// %s\n'
+                '__BRYTHON__.precompiled_main = [%s, function(){\n%s\n}]\n' %
+                (path, json.dumps(path), javascript))
+    if is_js:
+        javascript += '\nreturn $module'
+    return ('// %s\n'
+            '__BRYTHON__.precompiled[%s] = [%s, %s, function(){\n%s\n}, %s]\n'
+            % (path, json.dumps(name), json.dumps(path), json.dumps(is_package),
+               javascript, json.dumps(is_js)))
+
+def bundle(page):
+    """The javascript which runs a page: the loader, the modules its script
+       may import, and the compiled script."""
+    main, modules = compile_page(page)
+    return ''.join(['// %s, built by build.py.\n' % page, loader_js] +
+                   [module_js(name, *modules[name])
+                    for name in sorted(modules)] +
+                   [module_js('__main__', page_script(page)[0], False, main)])
+
+def write_hashed(name, contents):
+    """Writes contents to build/<name>.<hash>.js, and gzipped to the same name
+       with .gz added. Returns the path."""
+    contents = contents.encode('utf-8')
+    digest = hashlib.sha1(contents).hexdigest()[:10]
+    path = '%s/%s.%s.js' % (build_dir, name, digest)
+    write(path, contents)
+    write(path + '.gz', gzip.compress(contents, 9, mtime=0))
+    return path
+
+def set_scripts(page, tags):
+    """Replaces what is between the page's build.py markers."""
+    html = read(page)
+    write(page, block_re.sub(lambda m: m.group(1) + ''.join(
+                                 tag + '\n' for tag in tags) + m.group(3),
+                             html, count=1))
+
+def clean():
+    for page in pages:
+        set_scripts(page, [page_script(page)[2]])
+    shutil.rmtree(os.path.join(root, build_dir), ignore_errors=True)
+
+def build():
+    """Bundles every page, and returns {page: path of its bundle}."""
+    shutil.rmtree(os.path.join(root, build_dir), ignore_errors=True)
+    os.mkdir(os.path.join(root, build_dir))
+    bundles = {}
+    for page in pages:
+        bundles[page] = write_hashed(os.path.splitext(page)[0], bundle(page))
+        tag = page_script(page)[2].replace('text/python', compiled_type, 1)
+        set_scripts(page, [tag, '<script src="%s"></script>' % bundles[page]])
+    return bundles
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compile the pages' python to javascript ahead of time.")
+    parser.add_argument('--clean', action='store_true',
+                        help="go back to compiling in the browser")
+    args = parser.parse_args()
+    if args.clean:
+        clean()
+        exit(0)
+    for page, path in sorted(build().items()):
+        print("%s: %s, %i kB, %i kB gzipped" % (
+            page, path, os.path.getsize(os.path.join(root, path)) // 1024,
+            os.path.getsize(os.path.join(root, path + '.gz')) // 1024))
+    exit(0)
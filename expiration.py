@@ -1,27 +1,32 @@
 #!/usr/bin/python
 # Checks limbo stock for expired goods.
-from server import sql_database, Items, ExpiryEvents, Sellers, DBConnection
-import sqlite3 as sql
+from server import Items, ExpiryEvents, Sellers, DBConnection
 import datetime
 
+def expire_items(conn, now, dry_run=True):
+    """Records an ExpiryEvent for every item which expired before now and
+       removes it from stock, unless dry_run. Returns the expired items."""
+    items = Items.select(conn, "ExpiryDate < ?", now)
+    if dry_run:
+        return items
+    for item in items:
+        seller_records = Sellers.select(conn, "ItemName=?", item.Name)
+        # Record the ExpiryEvent
+        for seller_record in seller_records:
+            ExpiryEvents.insert(conn, item.Name, now, item.StockDate,
+                                item.ExpiryDate, seller_record.Seller,
+                                seller_record.ProfitSplit,
+                                item.Price, item.Count, item.Tax)
+        Sellers.delete(conn, "ItemName=?", item.Name)
+    # Delete all expired items from Items
+    Items.delete(conn, "ExpiryDate < ?", now)
+    return items
+
 if __name__ == '__main__':
     dry_run = True
     with DBConnection() as conn:
         now = datetime.datetime.now()
-        items = Items.select(conn, "ExpiryDate < ?", now)
-        for item in items:
+        for item in expire_items(conn, now, dry_run):
             print("Deleting expired item %s, set to expire on %s." %
                   (item.Name, item.ExpiryDate))
-            if dry_run:
-                continue
-            seller_records = Sellers.select(conn, "ItemName=?", item.Name)
-            # Record the ExpiryEvent
-            for seller_record in seller_records:
-                ExpiryEvents.insert(conn, item.Name, now, item.StockDate,
-                                    item.ExpiryDate, seller_record.Seller,
-                                    seller_record.ProfitSplit,
-                                    item.Price, item.Count, item.Tax)
-        if not dry_run:
-            # Delete all expired items from Items
-            Items.delete(conn, "ExpiryDate < ?", now)
     exit(0)
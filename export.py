@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+# Exports the history of the whole store, or of one user, as CSV. Users can
+# download their own history from the store page; this is for the treasurer.
+# It reads a consistent snapshot without holding up the store, and streams the
+# rows, so it can be run on the live database however long the history is.
+#
+#     ./export.py [--user NAME] [--start DATE] [--end DATE]
+#                 [--kinds purchase,transfer,...] [-o FILE]
+import sys
+from server import *
+from actions import history_csv, history_sources
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Export history as CSV.")
+    parser.add_argument('--user', help="only this user's history")
+    parser.add_argument('--start', help="first date included, e.g. 2015-01-01")
+    parser.add_argument('--end', help="first date excluded")
+    parser.add_argument('--kinds', help="comma-separated, from %s" %
+                        ', '.join(kind for kind, _, _ in history_sources))
+    parser.add_argument('-o', '--output', help="file to write (default stdout)")
+    args = parser.parse_args()
+    kinds = args.kinds.split(',') if args.kinds else None
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    with DBConnection(readonly=True) as conn:
+        for chunk in history_csv(conn, args.user, args.start, args.end, kinds):
+            output.write(chunk)
+    output.close()
+    exit(0)
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# Fills a new, empty database with a synthetic store: users, items with one or
+# more sellers, and a history of purchases, transfers, deposits, restocking,
+# expired items and donations. This is for benchmarks and for trying things out,
+# never for the real database.
+#
+#     ./gendata.py scratch.db [--users N] [--items N] [--purchases N] ...
+#
+# The history is consistent: every balance agrees with reverify.py and with the
+# ledger.
+import os
+import random
+import datetime
+import server
+from server import *
+
+# How many rows of each kind generate() makes by default.
+defaults = dict(users=100, items=200, purchases=10000, transfers=1000,
+                balance_changes=2000, restocks=500, expiries=100, donations=50,
+                days=365)
+
+first_names = ['Aaron', 'Andre', 'Belen', 'Chloe', 'Dmitri', 'Esther', 'Farid',
+               'Grace', 'Hiro', 'Ines', 'Jamal', 'Keegan', 'Linus', 'Maya',
+               'Nadia', 'Oscar', 'Priya', 'Quinn', 'Rosa', 'Sven', 'Tariq',
+               'Uma', 'Viktor', 'Wen', 'Xander', 'Yusuf', 'Zoe']
+brands = ['Doritos', 'Cheetos', 'Lays', 'Pringles', 'Oreo', 'Snickers', 'Twix',
+          'Kit Kat', 'Mountain Dew', 'Coca-Cola', 'Red Bull', 'Clif',
+          'Nature Valley', 'Pocky', 'Haribo', 'Skittles', 'Ramen', 'Pop-Tarts',
+          'Nissin', 'Sriracha']
+products = ['Cool Ranch', 'Nacho Cheese', 'Original', 'Sour Cream', 'BBQ',
+            'Chocolate', 'Peanut Butter', 'Strawberry', 'Mint', 'Spicy',
+            'Cherry', 'Vanilla', 'Honey', 'Salted Caramel', 'Lime']
+sizes = ['', ' (small)', ' (large)', ' bag', ' can', ' 12-pack', ' bar']
+
+def usernames(n):
+    return [first_names[i % len(first_names)] +
+            ('' if i < len(first_names) else str(i // len(first_names)))
+            for i in range(n)]
+
+def item_names(rng, n):
+    names = []
+    seen = set()
+    while len(names) < n:
+        name = '%s %s%s' % (rng.choice(brands), rng.choice(products),
+                            rng.choice(sizes))
+        if name in seen:
+            name = '%s #%i' % (name, len(names))
+        seen.add(name)
+        names.append(name)
+    return names
+
+def insert_rows(conn, table, rows):
+    conn.executemany("INSERT INTO %s VALUES(%s)" %
+                     (table.name, ', '.join('?' * len(table.fields))), rows)
+
+def generate(seed=4, **volumes):
+    """Creates the tables in server.sql_database, which must not exist yet,
+       and fills them. Keyword arguments override the defaults above. Returns a
+       dictionary with the lists of 'usernames' and in-stock 'items', and the
+       change 'version' the store starts at."""
+    import actions
+    import reverify
+    volumes = dict(defaults, **volumes)
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=volumes['days'])
+    def random_date():
+        return start + datetime.timedelta(seconds=rng.uniform(
+            0, volumes['days'] * 86400))
+
+    users = usernames(volumes['users'])
+    # Half of the catalog is in stock, the rest sold out or expired earlier.
+    catalog = item_names(rng, 2 * volumes['items'])
+    in_stock = catalog[:volumes['items']]
+    prices = dict((name, rng.randrange(25, 500, 5)) for name in catalog)
+    taxes = dict((name, rng.choice((0, 500, 500))) for name in catalog)
+    sellers = {}
+    for name in catalog:
+        if rng.random() < 0.2:
+            sellers[name] = [(rng.choice(users), 4500),
+                             (rng.choice(users), 5500 - taxes[name])]
+        else:
+            sellers[name] = [(rng.choice(users), 10000 - taxes[name])]
+        if sellers[name][0][0] == sellers[name][-1][0]:
+            sellers[name] = [(sellers[name][0][0], 10000 - taxes[name])]
+    stockdates = dict((name, start) for name in catalog)
+    # A few items in stock have already expired, waiting for expiration.py.
+    expirydates = dict((name, now + datetime.timedelta(
+                            days=rng.randrange(-14, 365)))
+                       for name in catalog)
+
+    actions.initialize_test_database()
+    with DBConnection() as conn:
+        # Loading is much faster without the triggers which keep the table
+        # versions and the change log; they are put back at the end.
+        for (trigger,) in conn.execute("SELECT name FROM sqlite_master WHERE "
+                                       "type='trigger'").fetchall():
+            conn.execute("DROP TRIGGER %s" % trigger)
+        insert_rows(conn, Users,
+                    ((name, '%s@example.com' % name.lower(), 0,
+                      1000000 + i, start) for i, name in enumerate(users)))
+        insert_rows(conn, Items,
+                    ((name, rng.randrange(1, 50), prices[name], taxes[name],
+                      stockdates[name], expirydates[name],
+                      'Tasty %s, stocked for everyone.' % name)
+                     for name in in_stock))
+        insert_rows(conn, Sellers,
+                    ((name, seller, split) for name in in_stock
+                     for seller, split in sellers[name]))
+
+        # Purchases come in carts of one to three items, like checkout_cart
+        # records them: the items of a cart share its date, and each cart gets
+        # a date of its own.
+        step = volumes['days'] * 86400.0 / max(1, volumes['purchases'])
+        def purchase_rows():
+            i = 0
+            while i < volumes['purchases']:
+                date = start + datetime.timedelta(seconds=i * step)
+                buyer = rng.choice(users)
+                cart = rng.sample(catalog, min(rng.choice((1, 1, 2, 3)),
+                                               volumes['purchases'] - i))
+                for name in cart:
+                    count = rng.choice((1, 1, 1, 2, 3))
+                    for seller, split in sellers[name]:
+                        yield (name, date, stockdates[name],
+                               expirydates[name], buyer, seller, split,
+                               prices[name], count, taxes[name])
+                i += len(cart)
+        insert_rows(conn, Purchases, purchase_rows())
+        insert_rows(conn, Transfers,
+                    ((random_date(), rng.choice(users), rng.choice(users),
+                      rng.randrange(1, 2000))
+                     for i in range(volumes['transfers'])))
+        insert_rows(conn, BalanceChanges,
+                    ((random_date(), rng.choice(users),
+                      rng.choice((-1, 1, 1)) * rng.randrange(100, 5000))
+                     for i in range(volumes['balance_changes'])))
+        def stocking_rows():
+            for name in in_stock:
+                for seller, split in sellers[name]:
+                    yield (name, start, start, expirydates[name], seller,
+                           split, prices[name], 0, 20, taxes[name])
+            for i in range(volumes['restocks']):
+                name = rng.choice(in_stock)
+                old_count = rng.randrange(0, 20)
+                for seller, split in sellers[name]:
+                    yield (name, random_date(), start, expirydates[name],
+                           seller, split, prices[name], old_count,
+                           old_count + rng.randrange(1, 10), taxes[name])
+        insert_rows(conn, Stocking, stocking_rows())
+        expired = catalog[volumes['items']:]
+        def expiry_rows():
+            for i in range(min(volumes['expiries'], len(expired))):
+                name = expired[i]
+                for seller, split in sellers[name]:
+                    yield (name, random_date(), start, start, seller, split,
+                           prices[name], rng.randrange(1, 5), taxes[name])
+        insert_rows(conn, ExpiryEvents, expiry_rows())
+        insert_rows(conn, Donations,
+                    ((random_date(), rng.randrange(100, 2000))
+                     for i in range(volumes['donations'])))
+
+        # Balances follow from the history, and the ledger starts from them.
+        balances = reverify.expected_balances(conn)
+        conn.executemany("UPDATE Users SET Balance=? WHERE Name=?",
+                         ((balance, name)
+                          for name, balance in balances.items()))
+        insert_rows(conn, Ledger,
+                    ((None, now, name, balance, 'opening')
+                     for name, balance in balances.items() if balance != 0))
+        add_table_versions(conn)
+        add_change_log(conn)
+        version = change_version(conn)
+    return dict(usernames=users, items=in_stock, version=version)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate a synthetic store.")
+    parser.add_argument('database', help="path of the new database file")
+    for name, value in sorted(defaults.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=int,
+                            default=value)
+    parser.add_argument('--seed', type=int, default=4)
+    args = vars(parser.parse_args())
+    database = args.pop('database')
+    if os.path.exists(database):
+        print("%s already exists; gendata.py only creates new databases." %
+              database)
+        exit(1)
+    server.sql_database = database
+    generate(**args)
+    exit(0)
@@ -1,5 +1,5 @@
 from browser import doc
-from limbo import async_request, Keycode, redirect, notify
+from limbo import async_request, cached_request, Keycode, redirect, notify
 
 def login_event(event):
     """This is called when the login button is pressed."""
@@ -18,7 +18,7 @@ def get_usernames_done(usernames):
 
 def login(username):
     """This is called when the login button is pressed."""
-    async_request(login_done, action="username", username=repr(username))
+    async_request(login_done, action="username", username=username)
 
 def login_done(user_data):
     """If the server has returned data, then the username exists and we may
@@ -53,7 +53,7 @@ def donate_event(event):
 
 # Populate the variable "usernames".
 ## Todo: have a timeout to reload this.
-async_request(get_usernames_done, action="usernames")
+cached_request(get_usernames_done, action="usernames")
 
 doc['username'].bind('keydown', keydown_event)
 doc['login_button'].bind('click', login_event)
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+# Checks user balances against the ledger, which records every change to a
+# balance. It is recommended to run "./ledger.py checkpoint" from cron, so that
+# verifying a balance only has to read the ledger entries since its last
+# checkpoint.
+#
+#     ./ledger.py checkpoint    write checkpoints for users with many new
+#                               entries
+#     ./ledger.py verify        compare every user's balance with the ledger
+from server import *
+import sys
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'checkpoint':
+        with DBConnection() as conn:
+            written = checkpoint_ledger(conn)
+        print("Wrote %i checkpoints." % written)
+    elif command == 'verify':
+        with DBConnection(readonly=True) as conn:
+            mismatches = verify_ledger(conn)
+        for username, balance, expected in mismatches:
+            print("User %s" % username)
+            print("\tRecorded balance is %s." % format_cents(balance))
+            print("\tLedger balance is %s" % format_cents(expected))
+        if not mismatches:
+            print("All balances agree with the ledger.")
+        exit(1 if mismatches else 0)
+    else:
+        print("usage: ledger.py checkpoint|verify")
+        exit(2)
+    exit(0)
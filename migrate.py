@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# Upgrades the schema of the limbo database in place by applying any migrations
+# from server.py which it is missing. A backup copy of the database is made
+# first.
+#
+#     ./migrate.py            apply pending migrations
+#     ./migrate.py --check    show the query plan of every hot query, and fail
+#                             if any of them scans a whole table
+from server import *
+import sys
+
+def backup(version):
+    """Copies the database next to itself before migrating it."""
+    filename = '%s-schema%i.bak' % (sql_database, version)
+    with DBConnection(readonly=True) as conn:
+        target = sql.connect(filename)
+        conn.backup(target)
+        target.close()
+    return filename
+
+def check_query_plans():
+    all_indexed = True
+    with DBConnection(readonly=True) as conn:
+        for table, where in hot_queries:
+            steps, indexed = query_plan(conn, table, where)
+            print("%-4s %s WHERE %s" % ("ok" if indexed else "SCAN",
+                                        table.name, where))
+            for step in steps:
+                print("         %s" % step)
+            all_indexed = all_indexed and indexed
+    return all_indexed
+
+if __name__ == '__main__':
+    if '--check' in sys.argv:
+        exit(0 if check_query_plans() else 1)
+    with DBConnection() as conn:
+        version = schema_version(conn)
+    if version == migrations[-1][0]:
+        print("Database is up to date (schema version %i)." % version)
+        exit(0)
+    print("Backed up database to %s" % backup(version))
+    for version, name in migrate():
+        print("Applied migration %i: %s" % (version, name))
+    exit(0)
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# Pushes changes to the stock and to balances to every open store page over a
+# WebSocket, so that a page no longer offers the last bag of chips after
+# another kiosk has bought it.
+#
+#     ./push.py --port 8001
+#
+# Pages connect to this port on the same host (see listen() in limbo.py). The
+# server looks for new entries in the ChangeLog (see server.py) a few times a
+# second, and sends what changed to every page as JSON, exactly as the
+# changes_since action would return it. It doesn't matter who made the changes:
+# wsgi.py, the cgi script or any of the scripts.
+#
+# Anyone can connect, so only the names of the users that changed are sent,
+# never their emails, IDs or balances; a page whose user is among them asks for
+# its own balance.
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import base64
+import struct
+import hashlib
+import threading
+from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+from actions import select_changes, encode_json
+from server import *
+
+#### WebSocket Protocol (RFC 6455) #############################################
+
+websocket_guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+TEXT, CLOSE, PING, PONG = 0x1, 0x8, 0x9, 0xA
+
+def read_headers(rfile):
+    """Reads an HTTP request up to its blank line. Returns its headers, with
+       lowercase names."""
+    rfile.readline() # GET / HTTP/1.1
+    headers = {}
+    while True:
+        line = rfile.readline(65537).decode('latin-1').strip()
+        if not line:
+            return headers
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+def handshake(rfile, wfile):
+    """Accepts the client's upgrade to a WebSocket. Returns False, after
+       answering with an error, if the request isn't a WebSocket one."""
+    headers = read_headers(rfile)
+    key = headers.get('sec-websocket-key')
+    if key is None or headers.get('upgrade', '').lower() != 'websocket':
+        wfile.write(b'HTTP/1.1 400 Bad Request\r\n'
+                    b'Content-Length: 0\r\n\r\n')
+        return False
+    accept = base64.b64encode(hashlib.sha1(
+        (key + websocket_guid).encode('ascii')).digest())
+    wfile.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                b'Upgrade: websocket\r\n'
+                b'Connection: Upgrade\r\n'
+                b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+    wfile.flush()
+    return True
+
+def encode_frame(payload, opcode=TEXT):
+    """A single, final, unmasked frame, as servers send them."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+def read_exactly(rfile, n):
+    data = rfile.read(n)
+    if len(data) < n:
+        raise EOFError
+    return data
+
+def read_frame(rfile):
+    """Reads the next frame sent by a client, and returns (opcode, payload).
+       Raises EOFError if the connection is closed."""
+    first, second = read_exactly(rfile, 2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack('!H', read_exactly(rfile, 2))
+    elif length == 127:
+        length, = struct.unpack('!Q', read_exactly(rfile, 8))
+    mask = read_exactly(rfile, 4) if second & 0x80 else b'\0\0\0\0'
+    payload = read_exactly(rfile, length)
+    payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return first & 0x0F, payload
+
+#### Broadcasting ##############################################################
+
+class Client():
+    """An open WebSocket. Frames are sent both from the thread reading from
+       the client and from the broadcaster, one at a time."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, payload, opcode=TEXT):
+        with self.lock:
+            self.wfile.write(encode_frame(payload, opcode))
+            self.wfile.flush()
+
+class Broadcaster():
+    """Sends every change in the ChangeLog to all connected clients."""
+    poll_interval = 0.25 # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.version = None
+
+    def add(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def poll(self):
+        """Broadcasts whatever changed since the last poll, users by name
+           only (see select_changes). Only the version is read when nothing
+           did."""
+        with DBConnection(readonly=True) as conn:
+            version = change_version(conn)
+            if self.version is None or version <= self.version:
+                # Clients catch up on what happened before they connected
+                # themselves, so there is nothing to send at first.
+                self.version = version
+                return
+            changes = select_changes(conn, self.version)
+        self.version = changes['version']
+        self.broadcast(encode_json(changes).encode('utf-8'))
+
+    def broadcast(self, payload):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.send(payload)
+            except OSError:
+                self.remove(client)
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except sql.Error:
+                pass # locked or being migrated; try again next time
+            time.sleep(self.poll_interval)
+
+broadcaster = Broadcaster()
+
+class PushHandler(StreamRequestHandler):
+    def handle(self):
+        if not handshake(self.rfile, self.wfile):
+            return
+        client = Client(self.wfile)
+        broadcaster.add(client)
+        try:
+            # Pages don't send anything, but the protocol has to be answered.
+            while True:
+                opcode, payload = read_frame(self.rfile)
+                if opcode == CLOSE:
+                    client.send(payload[:2], CLOSE)
+                    break
+                if opcode == PING:
+                    client.send(payload, PONG)
+        except (EOFError, OSError):
+            pass
+        finally:
+            broadcaster.remove(client)
+
+class ThreadingPushServer(ThreadingMixIn, TCPServer):
+    """Each page keeps its own thread for as long as it is open."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(host='', port=8001):
+    threading.Thread(target=broadcaster.run, daemon=True).start()
+    return ThreadingPushServer((host, port), PushHandler)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Push stock and balance changes to Limbo4 pages.")
+    parser.add_argument('--host', default='',
+                        help="address to listen on (default: all)")
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+    httpd = serve(args.host, args.port)
+    print("Pushing changes on ws://%s:%i/" % (args.host or '*', args.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
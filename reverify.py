@@ -2,40 +2,72 @@
 # Computes what balances should be based on transaction history, then gives the
 # option to update balances to reflect history. This tool is mostly good for
 # fixing bugs.
+#
+# Each kind of history is summed for all users at once by a grouped query, so
+# this reads every history table once no matter how many users there are.
 from server import *
 import sqlite3 as sql
 import datetime
 
+# (sign, query) pairs; each query returns rows of (username, total in cents).
+# Purchases is read NOT INDEXED: reading the whole table in order and sorting
+# the groups is much faster than a row lookup for every entry of an index.
+history_totals = [
+    # Deposits and withdrawals.
+    (+1, "SELECT User, SUM(Amount) FROM BalanceChanges GROUP BY User"),
+    # The amount of money a seller gets is PriceEach * Count * ProfitSplit,
+    # rounded down to the cent (integer division). Since the sum of
+    # ProfitSplits *and* Tax adds up to 10000, limbo keeps the rest.
+    (+1, "SELECT Seller, SUM(PriceEach * Count * ProfitSplit / 10000) "
+         "FROM Purchases NOT INDEXED GROUP BY Seller"),
+    (+1, "SELECT Receiver, SUM(Amount) FROM Transfers GROUP BY Receiver"),
+    # The amount of money a buyer pays is PriceEach * Count, but we record it
+    # multiple times (one for each seller). So we need to count only one row
+    # for each item bought at each date; the items of a cart share its date.
+    (-1, "SELECT Buyer, SUM(PriceEach * Count) FROM "
+         "(SELECT Buyer, PriceEach, Count FROM Purchases NOT INDEXED "
+         "GROUP BY Buyer, Date, ItemName) "
+         "GROUP BY Buyer"),
+    (-1, "SELECT Sender, SUM(Amount) FROM Transfers GROUP BY Sender"),
+]
+
+def expected_balances(conn):
+    """Returns a dictionary of every user's balance according to the history
+       tables."""
+    balances = dict((user.Name, 0) for user in
+                    Users.iterate(conn, None, columns=('Name',)))
+    for sign, query in history_totals:
+        for username, total in conn.execute(query):
+            if username in balances:
+                balances[username] += sign * total
+    return balances
+
+def find_discrepancies(conn):
+    """Returns a dictionary of username -> (recorded, expected balance) for
+       every user whose balance doesn't match their history."""
+    expected = expected_balances(conn)
+    discrepancies = {}
+    for user in Users.iterate(conn, None, columns=('Name', 'Balance')):
+        if user.Balance != expected[user.Name]:
+            discrepancies[user.Name] = (user.Balance, expected[user.Name])
+    return discrepancies
+
 if __name__ == '__main__':
     with DBConnection() as conn:
-        users = Users.select(conn, where=None)
         fixes = {}
-        for user in users:
-            # The amount of money a buyer pays is PriceEach * Count, but we record
-            # it multiple times (one for each seller). So we need to not select
-            # multiple rows with the same date.
-            purchases = Purchases.select(conn, "Buyer = ? group by Date", user.Name)
-            # The amount of money a seller gets is PriceEach * Count * ProfitSplit
-            # Since the sum of ProfitSplits *and* Tax adds up to 1.0
-            sales = Purchases.select(conn, "Seller = ?", user.Name)
-            transfers = Transfers.select(conn, "Sender = ?", user.Name)
-            received = Transfers.select(conn, "Receiver = ?", user.Name)
-            changes = BalanceChanges.select(conn, "User = ?", user.Name)
-            revenue = (sum(dollar_amount(change.Amount) for change in changes)
-                       + sum(round_dollar_amount(dollar_amount(sale.PriceEach) * int(sale.Count) * Decimal(sale.ProfitSplit)) for sale in sales)
-                       + sum(dollar_amount(receival.Amount) for receival in received)
-                       - sum(round_dollar_amount(dollar_amount(purchase.PriceEach) * int(purchase.Count)) for purchase in purchases)
-                       - sum(dollar_amount(transfer.Amount) for transfer in transfers))
-            balance = user.Balance
-            if (balance != str(revenue)):
-                print("User %s" % user.Name)
-                print("\tRecorded balance is %s." % balance)
-                print("\tExpected balance is %s" % revenue)
-                fixes[user.Name] = revenue
+        for username, (balance, revenue) in find_discrepancies(conn).items():
+            print("User %s" % username)
+            print("\tRecorded balance is %s." % format_cents(balance))
+            print("\tExpected balance is %s" % format_cents(revenue))
+            fixes[username] = revenue
         print("Would you like to fix all balances? [y/n]")
         if input() == 'y':
+            date = datetime.datetime.now()
             for username, new_balance in fixes.items():
-                Users.update(conn, "Balance=?", "Name=?", str(new_balance), username)
+                # Go through the ledger, so that it agrees with the fix.
+                old_balance = Users.select_one(conn, "Name=?", username).Balance
+                adjust_balance(conn, date, username, new_balance - old_balance,
+                               'correction')
 
 
     exit(0)
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# Ranked, typo-tolerant search of the items in stock by name and description,
+# for the server's search action (see actions.py), which the store page's search
+# box calls as it is typed in.
+#
+# Every word of a name or description is indexed under its first few letters,
+# so that "dor" finds "Doritos" while it is being typed, and under its
+# trigrams, so that "dorritos" still does. Matches in names count for more than
+# matches in descriptions, and whole prefixes for more than trigrams.
+
+# Words are indexed under their prefixes up to this length; longer query words
+# are matched by their first letters and their trigrams.
+prefix_length = 6
+# The share of a query word's trigrams an indexed word must have to match it.
+min_similarity = 0.5
+
+# Terms are the kind followed by the prefix or trigram, with these weights.
+prefix_kinds = [('n<', 4.0), ('d<', 1.0)]
+trigram_kinds = [('n#', 2.0), ('d#', 0.5)]
+
+# How alike two items must be for similar() to find them, from 0 to 1.
+min_resemblance = 0.5
+
+def words(text):
+    """The lowercase words of a text: its runs of letters and digits."""
+    result = []
+    word = ''
+    for c in text.lower():
+        if c.isalnum():
+            word += c
+        elif word:
+            result.append(word)
+            word = ''
+    if word:
+        result.append(word)
+    return result
+
+def trigrams(word):
+    """The word's trigrams, with a space before and after it so that its ends
+       count too."""
+    padded = ' %s ' % word
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+def terms(name, description):
+    """The terms an item is indexed under; some may repeat."""
+    result = []
+    for field, text in (('n', name), ('d', description)):
+        for word in words(text):
+            for length in range(1, min(len(word), prefix_length) + 1):
+                result.append(field + '<' + word[:length])
+            if len(word) >= 3:
+                for trigram in trigrams(word):
+                    result.append(field + '#' + trigram)
+    return result
+
+class SearchIndex():
+    """The index of items by name and description. Items are added and
+       removed one by one as the stock changes."""
+    def __init__(self):
+        self.ids = {}            # item name -> id
+        self.names = []          # id -> item name, None if the id is free
+        self.item_terms = []     # id -> indexes of its terms in self.postings
+        self.trigram_counts = [] # id -> kind -> number of distinct trigrams
+        self.free = []           # ids to reuse
+        self.term_ids = {}       # term -> index in self.postings
+        self.postings = []       # the ids of the items under each term
+
+    def __len__(self):
+        return len(self.names) - len(self.free)
+
+    def add(self, name, description=''):
+        """Indexes an item, or indexes it again if it already was."""
+        self.remove(name)
+        if self.free:
+            id = self.free.pop()
+            self.names[id] = name
+        else:
+            id = len(self.names)
+            self.names.append(name)
+            self.item_terms.append(None)
+            self.trigram_counts.append(None)
+        self.ids[name] = id
+        indexes = []
+        counts = dict((kind, 0) for kind, weight in trigram_kinds)
+        for term in terms(name, description):
+            index = self.term_ids.get(term)
+            if index is None:
+                index = len(self.postings)
+                self.term_ids[term] = index
+                self.postings.append([])
+            posting = self.postings[index]
+            # The item's terms are all added now, so a repeated one would be
+            # last.
+            if not posting or posting[-1] != id:
+                posting.append(id)
+                indexes.append(index)
+                if term[:2] in counts:
+                    counts[term[:2]] += 1
+        self.item_terms[id] = indexes
+        self.trigram_counts[id] = counts
+
+    def remove(self, name):
+        """Takes an item out of the index, if it is in."""
+        id = self.ids.pop(name, None)
+        if id is None:
+            return
+        for index in self.item_terms[id]:
+            self.postings[index].remove(id)
+        self.names[id] = None
+        self.item_terms[id] = None
+        self.trigram_counts[id] = None
+        self.free.append(id)
+
+    def posting(self, term):
+        index = self.term_ids.get(term)
+        return [] if index is None else self.postings[index]
+
+    def search(self, query, limit=None):
+        """The names of the items matching the words of query, best first, at
+           most limit of them. Each word adds to an item's score for each
+           field it matches in, either as the beginning of a word or by sharing
+           enough trigrams with one."""
+        scores = [0] * len(self.names)
+        counts = [0] * len(self.names)
+        found = [] # the ids scored, in the order first scored
+        for word in words(query):
+            for kind, weight in prefix_kinds:
+                for id in self.posting(kind + word[:prefix_length]):
+                    if scores[id] == 0:
+                        found.append(id)
+                    scores[id] += weight
+            if len(word) < 3:
+                continue
+            word_trigrams = trigrams(word)
+            for kind, weight in trigram_kinds:
+                counted = []
+                for trigram in word_trigrams:
+                    for id in self.posting(kind + trigram):
+                        if counts[id] == 0:
+                            counted.append(id)
+                        counts[id] += 1
+                for id in counted:
+                    similarity = counts[id] / len(word_trigrams)
+                    counts[id] = 0
+                    if similarity >= min_similarity:
+                        if scores[id] == 0:
+                            found.append(id)
+                        scores[id] += weight * similarity
+        ranked = sorted((-scores[id], self.names[id]) for id in found)
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [name for points, name in ranked]
+
+    def similar(self, name, description='', limit=None):
+        """The names of the items most like one with this name and description,
+           most alike first, at most limit of them. How alike two names (or two
+           descriptions) are is the share of trigrams they have in common, so
+           that "doritos bag" and "Doritos (large)" are both like "Doritos";
+           names weigh more than descriptions, which only count if given."""
+        query_trigrams = {}
+        for term in terms(name, description):
+            if term[1] == '#':
+                query_trigrams[term] = True
+        resemblance = [0] * len(self.names)
+        found = []
+        total_weight = 0
+        for kind, weight in trigram_kinds:
+            query_count = sum(1 for term in query_trigrams
+                              if term.startswith(kind))
+            if not query_count:
+                continue
+            total_weight += weight
+            shared = {}
+            for term in query_trigrams:
+                if term.startswith(kind):
+                    for id in self.posting(term):
+                        shared[id] = shared.get(id, 0) + 1
+            for id, count in shared.items():
+                if resemblance[id] == 0:
+                    found.append(id)
+                resemblance[id] += weight * 2 * count / (
+                    query_count + self.trigram_counts[id][kind])
+        ranked = sorted((-resemblance[id], self.names[id]) for id in found
+                        if resemblance[id] >= min_resemblance * total_weight)
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [name for points, name in ranked]
@@ -1,26 +1,167 @@
 import sqlite3 as sql
 import datetime
-# All prices should be manipulated as Decimal values roudned to two places after
-# the decimal point. All fractions should also be Decimal values.
-# Use str(decimal_value) to get the representation to put in the database.
+import os
+import time
+import atexit
+import threading
+# All amounts of money are integer numbers of cents, and all fractions (profit
+# splits, tax) are integer numbers of basis points, i.e. 1/10000ths. Amounts
+# sent by clients as strings like '1.25' are converted with cents() and
+# basis_points(); Decimal is only used for that parsing.
 import decimal
 from decimal import Decimal
-decimal.getcontext().prec = 6
-from collections import namedtuple
+from collections import namedtuple, deque
+from contextlib import contextmanager
 path_to_limbo = '/srv/http/limbo4/'
 
 # There's a decent sqlite tutorial here:
 # http://zetcode.com/db/sqlitepythontutorial/
-sql_database = path_to_limbo + 'data/limbo4.db'
+# Set LIMBO_DATABASE in the environment to use some other database file, for
+# example a scratch copy for testing.
+sql_database = os.environ.get('LIMBO_DATABASE',
+                              path_to_limbo + 'data/limbo4.db')
 
-def round_dollar_amount(decimal_price):
-    """Take a decimal value and round down to the nearest cent."""
-    return decimal_price.quantize(Decimal('.01'), rounding=decimal.ROUND_DOWN)
+def _scaled_integer(amount, places):
+    # str() first, so that a float such as 0.29 isn't read as 0.28999...
+    value = Decimal(str(amount)).scaleb(places)
+    return int(value.to_integral_value(rounding=decimal.ROUND_DOWN))
 
-def dollar_amount(string):
-    return round_dollar_amount(Decimal(string))
+def cents(amount):
+    """Converts a dollar amount (string, int, float or Decimal) to an integer
+       number of cents, rounding towards zero."""
+    return _scaled_integer(amount, 2)
+
+def basis_points(fraction):
+    """Converts a fraction such as '0.05' to integer basis points (500)."""
+    return _scaled_integer(fraction, 4)
+
+def format_cents(amount):
+    """Formats an integer number of cents as dollars, e.g. -105 -> '-1.05'."""
+    sign = '-' if amount < 0 else ''
+    return '%s%i.%02i' % (sign, abs(amount) // 100, abs(amount) % 100)
+
+def percentile(ordered, p):
+    """The p-th percentile of a sorted list, or 0.0 if it is empty."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+def share(amount, split):
+    """A profit split (in basis points) of an amount of cents, rounded down to
+       the nearest cent."""
+    return amount * split // 10000
+
+class LockStats():
+    """Keeps track of how long transactions had to wait for the database lock,
+       separately for read and write transactions."""
+    def __init__(self, history=1000):
+        self.lock = threading.Lock()
+        self.history = history
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.waits = {'read': deque(maxlen=self.history),
+                          'write': deque(maxlen=self.history)}
+            self.count = {'read': 0, 'write': 0}
+            self.total = {'read': 0.0, 'write': 0.0}
+            self.max = {'read': 0.0, 'write': 0.0}
+
+    def record(self, kind, wait):
+        with self.lock:
+            self.waits[kind].append(wait)
+            self.count[kind] += 1
+            self.total[kind] += wait
+            self.max[kind] = max(self.max[kind], wait)
+
+    def summary(self):
+        """Returns a dictionary of count, mean, max and recent p50/p99 lock
+           waits (in seconds) for each kind of transaction."""
+        with self.lock:
+            result = {}
+            for kind, waits in self.waits.items():
+                ordered = sorted(waits)
+                result[kind] = dict(count=self.count[kind],
+                                    mean=(self.total[kind] / self.count[kind]
+                                          if self.count[kind] else 0.0),
+                                    max=self.max[kind],
+                                    p50=percentile(ordered, 50),
+                                    p99=percentile(ordered, 99))
+            return result
+
+lock_stats = LockStats()
+
+class ConnectionPool():
+    """Keeps idle sqlite connections open so that every transaction doesn't
+       have to reopen the database. A connection is only ever used by one
+       transaction at a time, but may move between threads."""
+    # Write-ahead logging lets readers keep reading from their snapshot while
+    # a writer is busy, instead of everyone taking turns on one lock.
+    journal_mode = 'WAL'
+    # Seconds to wait for another writer before giving up.
+    timeout = 5.0
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {} # database path -> list of idle connections
+
+    def connect(self, database):
+        # isolation_level=None: we issue BEGIN ourselves, see DBConnection.
+        conn = sql.connect(database, timeout=self.timeout,
+                           isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=%s' % self.journal_mode)
+        return conn
+
+    def acquire(self, database):
+        with self.lock:
+            connections = self.idle.get(database)
+            if connections:
+                return connections.pop()
+        return self.connect(database)
+
+    def release(self, database, conn):
+        """Returns a connection, which must not be in a transaction, to the
+           pool."""
+        with self.lock:
+            connections = self.idle.setdefault(database, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
+
+pool = ConnectionPool()
 
 class DBConnection():
+    """Use as "with DBConnection() as conn:" to run a transaction, which is
+       committed at the end of the block or rolled back if there is an
+       exception.
+
+       Pass readonly=True for transactions which only read. These don't lock
+       out anyone else and see a consistent snapshot of the database. Writers
+       take the write lock right away (BEGIN IMMEDIATE), so that two writers
+       can't both read a balance and then fail to upgrade their locks.
+
+       database defaults to sql_database.
+
+       Within metrics.measure(), the transaction's lock wait, statements and
+       rows read are added to the current request's metrics."""
+    read_begin = 'BEGIN DEFERRED'
+    write_begin = 'BEGIN IMMEDIATE'
+
+    def __init__(self, readonly=False, database=None):
+        self.readonly = readonly
+        self.requested_database = database
+        self.lock_wait = 0.0
+        self.request = None
+
     def __enter__ (self):
         # Code to start a new transaction
         return self.cursor()
@@ -33,19 +174,55 @@ class DBConnection():
     
     def commit(self):
         "Commits current transaction"
-        self.conn.commit()
-        self.conn.close()
+        self.stop_counting()
+        try:
+            self.conn.execute('COMMIT')
+        except:
+            self.rollback()
+            raise
+        pool.release(self.database, self.conn)
     
     def cursor(self):
-        "Returns a cursor object and starts a new transaction"
-        self.conn = sql.connect(sql_database)
-        self.conn.isolation_level = 'EXCLUSIVE'
-        self.conn.execute('BEGIN EXCLUSIVE')
+        "Returns a connection object and starts a new transaction"
+        self.database = self.requested_database or sql_database
+        self.conn = pool.acquire(self.database)
+        start = time.perf_counter()
+        try:
+            if self.readonly:
+                self.conn.execute(self.read_begin)
+                # A deferred transaction takes its snapshot (and its lock) on
+                # the first read, so read something to time it.
+                self.conn.execute('SELECT 1 FROM sqlite_master LIMIT 1')
+            else:
+                self.conn.execute(self.write_begin)
+        except:
+            self.rollback()
+            raise
+        self.lock_wait = time.perf_counter() - start
+        lock_stats.record('read' if self.readonly else 'write', self.lock_wait)
+        self.request = metrics.active()
+        if self.request is not None:
+            self.request.lock_wait += self.lock_wait
+            self.conn.set_trace_callback(self.request.count_statement)
+            self.conn.row_factory = self.request.count_row
         return self.conn
+
+    def stop_counting(self):
+        if self.request is not None:
+            self.conn.set_trace_callback(None)
+            self.conn.row_factory = None
+            self.request = None
     
     def rollback(self):
-        #self.conn.execute('ROLLBACK')
-        self.conn.close()
+        self.stop_counting()
+        try:
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+        except sql.Error:
+            # Don't put a broken connection back in the pool.
+            self.conn.close()
+        else:
+            pool.release(self.database, self.conn)
 
 #### DB Table Interactions #####################################################
 
@@ -54,26 +231,74 @@ class Table():
         self.name = name
         self.fields = fields
         self.fieldnames = [field.split()[0] for field in fields]
-        self.Tuple = namedtuple(self.name, self.fieldnames)
-        self.Tuple.__str__ = lambda T: str(tuple(T))
-        self.Tuple.__repr__ = lambda T: str(tuple(T))
+        self.Tuple = self.tuple_type(self.fieldnames)
+        self.projections = {}
+
+    def tuple_type(self, fieldnames):
+        Tuple = namedtuple(self.name, fieldnames)
+        Tuple.__str__ = lambda T: str(tuple(T))
+        Tuple.__repr__ = lambda T: str(tuple(T))
+        return Tuple
+
+    def projection(self, columns):
+        """The namedtuple type for rows with only the given columns."""
+        columns = tuple(columns)
+        if columns not in self.projections:
+            self.projections[columns] = self.tuple_type(columns)
+        return self.projections[columns]
         
-    def create(self, db_conn):
-        db_conn.execute("CREATE TABLE %s(%s)" %
-                              (self.name, ', '.join(self.fields)))
-    
-    def select(self, conn, where, *args):
-        query = "SELECT * FROM %s" % self.name
-        if where is not None:
-            query += " WHERE %s" % where
-        return list(self.Tuple(*row) for row in conn.execute(query, args))
+    def create(self, db_conn, if_not_exists=False):
+        db_conn.execute("CREATE TABLE %s%s(%s)" %
+                              ("IF NOT EXISTS " if if_not_exists else "",
+                               self.name, ', '.join(self.fields)))
 
-    def select_one(self, conn, where, *args):
-        query = "SELECT * FROM %s" % self.name
+    def query(self, what, where, order_by=None, limit=None):
+        query = "SELECT %s FROM %s" % (what, self.name)
         if where is not None:
             query += " WHERE %s" % where
+        if order_by is not None:
+            query += " ORDER BY %s" % order_by
+        if limit is not None:
+            query += " LIMIT %i" % limit
+        return query
+
+    def iterate(self, conn, where, *args, columns=None, order_by=None,
+                limit=None):
+        """Yields the rows matching where one at a time, so that a big table
+           can be walked without holding all of it in memory. columns selects
+           only some of the fields; order_by is an ORDER BY clause."""
+        if columns is None:
+            Tuple = self.Tuple
+            query = self.query('*', where, order_by, limit)
+        else:
+            Tuple = self.projection(columns)
+            query = self.query(', '.join(columns), where, order_by, limit)
         for row in conn.execute(query, args):
-            return self.Tuple(*row) # returns just the first row
+            yield Tuple(*row)
+    
+    def select(self, conn, where, *args, columns=None, order_by=None,
+               limit=None):
+        return list(self.iterate(conn, where, *args, columns=columns,
+                                 order_by=order_by, limit=limit))
+
+    def select_one(self, conn, where, *args, columns=None, order_by=None):
+        for row in self.iterate(conn, where, *args, columns=columns,
+                                order_by=order_by, limit=1):
+            return row # returns just the first row
+
+    def aggregate(self, conn, expression, where, *args):
+        """Returns the value of an aggregate expression such as
+           "MAX(Date)" over the rows matching where."""
+        return conn.execute(self.query(expression, where), args).fetchone()[0]
+
+    def count(self, conn, where, *args):
+        return self.aggregate(conn, "COUNT(*)", where, *args)
+
+    def sum(self, conn, expression, where, *args):
+        """The sum of an expression (such as "PriceEach * Count") over the
+           rows matching where; 0 if there are none."""
+        return self.aggregate(conn, "COALESCE(SUM(%s), 0)" % expression,
+                              where, *args)
     
     def delete(self, conn, where, *args):
         query = "DELETE FROM %s WHERE %s" % (self.name, where)
@@ -85,40 +310,42 @@ class Table():
         conn.execute(query, values)
         
     def update(self, conn, field, where, *args):
+        """Returns the number of rows updated."""
         query = "UPDATE %s SET %s WHERE %s" % (self.name, field, where)
-        conn.execute(query, args)
+        return conn.execute(query, args).rowcount
 
 #### DB Table Definitions ######################################################
 
 # Some notes on data storage:
-# Balance/Price are python decimal amounts, so they are stored as their
-# text representation.
+# Balance/Price/Amount are stored as INTEGER cents, and ProfitSplit/Tax as
+# INTEGER basis points (see cents() and basis_points()), so that sqlite can
+# sum and compare them.
 # All dates are stored in ISO 8601 format, which are the default string
 # representation of datetime objects.
 Users = Table("Users", "Name      TEXT PRIMARY KEY NOT NULL",
                        "Email     TEXT NOT NULL",
-                       "Balance   TEXT NOT NULL",
+                       "Balance   INTEGER NOT NULL",
                        "CaltechID INTEGER NOT NULL",
                        "JoinDate  TEXT NOT NULL")
 
 Items = Table("Items", "Name         TEXT PRIMARY KEY NOT NULL",
                        "Count        INTEGER NOT NULL",
-                       "Price        TEXT NOT NULL",
-                       "Tax          TEXT NOT NULL",
+                       "Price        INTEGER NOT NULL",
+                       "Tax          INTEGER NOT NULL",
                        "StockDate    TEXT NOT NULL",
                        "ExpiryDate   TEXT NOT NULL",
                        "Description  TEXT")
 
 # An item is allowed multiple sellers. We keep this in a separate table.
-# The "profit split" should be a percentage of the price, and should
-# always sum up to 100% or less (in the case of optional limbo tax).
+# The "profit split" should be a fraction of the price in basis points, and
+# should always sum up to 10000 or less (in the case of optional limbo tax).
 Sellers = Table("Sellers", "ItemName     TEXT NOT NULL",
                            "Seller       TEXT NOT NULL",
-                           "ProfitSplit  TEXT NOT NULL")
+                           "ProfitSplit  INTEGER NOT NULL")
 
 # Transactions
-# each field 'ProfitSplit' is some number between 0.0 and 1.0 inclusive.
-# likewise with tax, it is some number between 0.0 and 1.0 inclusive.
+# each field 'ProfitSplit' is some number between 0 and 10000 (basis points)
+# inclusive. likewise with tax, it is some number between 0 and 10000.
 #   Buying and Selling
 #     If a purchase has multiple sellers, then we use multiple rows.
 Purchases = Table("Purchases", "ItemName     TEXT NOT NULL",
@@ -127,19 +354,19 @@ Purchases = Table("Purchases", "ItemName     TEXT NOT NULL",
                                "ExpiryDate   TEXT NOT NULL",
                                "Buyer        TEXT NOT NULL",
                                "Seller       TEXT NOT NULL",
-                               "ProfitSplit  TEXT NOT NULL",
-                               "PriceEach    TEXT NOT NULL",
+                               "ProfitSplit  INTEGER NOT NULL",
+                               "PriceEach    INTEGER NOT NULL",
                                "Count        INTEGER NOT NULL",
-                               "Tax          TEXT NOT NULL")
+                               "Tax          INTEGER NOT NULL")
 
 Transfers = Table("Transfers", "Date       TEXT NOT NULL",
                                "Sender     TEXT NOT NULL",
                                "Receiver   TEXT NOT NULL",
-                               "Amount     TEXT NOT NULL")
+                               "Amount     INTEGER NOT NULL")
 
 BalanceChanges = Table("BalanceChanges", "Date       TEXT NOT NULL",
                                          "User       TEXT NOT NULL",
-                                         "Amount     TEXT NOT NULL")
+                                         "Amount     INTEGER NOT NULL")
 
 #   Stocking and Unstocking transactions
 #     If a stocked item has multiple sellers, then we use multiple rows.
@@ -148,15 +375,15 @@ Stocking = Table("Stocking", "ItemName     TEXT NOT NULL",
                              "StockDate    TEXT NOT NULL",
                              "ExpiryDate   TEXT NOT NULL",
                              "Seller       TEXT NOT NULL",
-                             "ProfitSplit  TEXT NOT NULL",
-                             "PriceEach    TEXT NOT NULL",
+                             "ProfitSplit  INTEGER NOT NULL",
+                             "PriceEach    INTEGER NOT NULL",
                              "OldCount     INTEGER NOT NULL",
                              "NewCount     INTEGER NOT NULL",
-                             "Tax          TEXT NOT NULL")
+                             "Tax          INTEGER NOT NULL")
 
 #   Anonymous Donations of cash
 Donations = Table("Donations", "Date       TEXT NOT NULL",
-                               "Amount     TEXT NOT NULL")
+                               "Amount     INTEGER NOT NULL")
 
 #   Expiration events
 #     If the expired item has multiple sellers, we use multiple rows.
@@ -165,16 +392,483 @@ ExpiryEvents = Table("ExpiryEvent", "ItemName     TEXT NOT NULL",
                                     "StockDate    TEXT NOT NULL",
                                     "ExpiryDate   TEXT NOT NULL",
                                     "Seller       TEXT NOT NULL",
-                                    "ProfitSplit  TEXT NOT NULL",
-                                    "PriceEach    TEXT NOT NULL",
+                                    "ProfitSplit  INTEGER NOT NULL",
+                                    "PriceEach    INTEGER NOT NULL",
                                     "Count        INTEGER NOT NULL",
-                                    "Tax          TEXT NOT NULL")
+                                    "Tax          INTEGER NOT NULL")
 
 # Statistics
 #   For keeping track of interesting data.
 #   Some entries, such as "transactions", are not cumulative but rather
 #   are the number of transactions since the last record.
 Statistics = Table("StatisticsRecord", "Date         TEXT NOT NULL",
-                                       "AvgBalance   TEXT",
-                                       "ExpectedCash TEXT",
+                                       "AvgBalance   INTEGER",
+                                       "ExpectedCash INTEGER",
                                        "Transactions INTEGER")
+
+# Ledger
+#   Every change to a user's balance is appended here as a signed amount, see
+#   adjust_balance(). Rows are never updated or deleted. Kind is one of
+#   'purchase', 'sale', 'transfer', 'balance', 'correction' or 'opening' (the
+#   balance a user had when the ledger was introduced).
+Ledger = Table("Ledger", "Id         INTEGER PRIMARY KEY",
+                         "Date       TEXT NOT NULL",
+                         "User       TEXT NOT NULL",
+                         "Amount     INTEGER NOT NULL",
+                         "Kind       TEXT NOT NULL")
+
+#   A checkpoint records a user's balance according to the ledger, up to and
+#   including the entry LedgerId, so that the ledger doesn't have to be summed
+#   from the beginning. See checkpoint_ledger().
+LedgerCheckpoints = Table("LedgerCheckpoint", "User       TEXT NOT NULL",
+                                              "LedgerId   INTEGER NOT NULL",
+                                              "Balance    INTEGER NOT NULL",
+                                              "Date       TEXT NOT NULL")
+
+#### Balances ##################################################################
+
+# A checkpoint is written for a user once this many ledger entries have piled up
+# since their last one.
+checkpoint_interval = 100
+
+def adjust_balance(conn, date, username, amount, kind):
+    """Adds an amount of cents (which may be negative) to a user's balance and
+       appends it to the ledger, within a transaction. Every change to a
+       balance should go through here."""
+    if not Users.update(conn, "Balance=Balance+?", "Name=?",
+                        amount, username):
+        raise ValueError("No such user %r" % username)
+    Ledger.insert(conn, None, date, username, amount, kind)
+
+def last_checkpoint(conn, username):
+    """Returns (LedgerId, Balance) of a user's latest checkpoint, or (0, 0)."""
+    row = LedgerCheckpoints.select_one(conn, "User=?", username,
+                                       columns=('LedgerId', 'Balance'),
+                                       order_by="LedgerId DESC")
+    return tuple(row) if row is not None else (0, 0)
+
+def ledger_balance(conn, username):
+    """A user's balance according to the ledger. Only the entries since the
+       user's last checkpoint are read."""
+    ledger_id, balance = last_checkpoint(conn, username)
+    return balance + Ledger.sum(conn, "Amount", "User=? AND Id>?",
+                                username, ledger_id)
+
+def checkpoint_ledger(conn, min_entries=checkpoint_interval):
+    """Writes a checkpoint for every user with at least min_entries ledger
+       entries since their last checkpoint. Returns the number written."""
+    date = datetime.datetime.now()
+    written = 0
+    for user in Users.iterate(conn, None, columns=('Name',)):
+        ledger_id, balance = last_checkpoint(conn, user.Name)
+        count, total, last_id = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(Amount), 0), MAX(Id) FROM Ledger "
+            "WHERE User=? AND Id>?", (user.Name, ledger_id)).fetchone()
+        if count and count >= min_entries:
+            LedgerCheckpoints.insert(conn, user.Name, last_id, balance + total,
+                                     date)
+            written += 1
+    return written
+
+def verify_ledger(conn):
+    """Compares every user's recorded balance with the ledger. Returns a list
+       of (username, recorded balance, ledger balance) which don't match."""
+    mismatches = []
+    for user in Users.iterate(conn, None, columns=('Name', 'Balance')):
+        expected = ledger_balance(conn, user.Name)
+        if expected != user.Balance:
+            mismatches.append((user.Name, user.Balance, expected))
+    return mismatches
+
+#### Change Versions ###########################################################
+
+# Every table in versioned_tables has a version number in TableVersion, which
+# triggers bump on every insert, update and delete, whoever makes the change.
+# A response computed from some tables is still current as long as their
+# versions haven't changed; see response_etag() in actions.py.
+TableVersions = Table("TableVersion", "Name       TEXT PRIMARY KEY NOT NULL",
+                                      "Version    INTEGER NOT NULL")
+
+versioned_tables = [Users, Items, Sellers, Purchases, Transfers, BalanceChanges,
+                    Stocking, Donations, ExpiryEvents]
+
+class PartVersion():
+    """The version in TableVersion of only part of a table, which triggers bump
+       on just some of its changes. It stands in for a table wherever a table's
+       version is asked for."""
+    def __init__(self, name):
+        self.name = name
+
+# Changes when users are added, removed or renamed, but not when a balance does.
+UserNames = PartVersion("UserNames")
+
+def table_versions(conn, tables):
+    """Returns the current versions of the given tables, in order."""
+    versions = dict(conn.execute(
+        "SELECT Name, Version FROM TableVersion WHERE Name IN (%s)" %
+        ', '.join('?' * len(tables)), [table.name for table in tables]))
+    return [versions[table.name] for table in tables]
+
+#### Change Log ################################################################
+
+# Triggers note which items, which items' sellers, and which users were
+# inserted, updated or deleted, so that a client holding an earlier copy of them
+# can ask for just what changed (see select_changes() in actions.py). Only the
+# latest change to each row is kept: its Id is the version at which the row last
+# changed, and whether it still exists tells an update from a deletion. The log
+# therefore never grows beyond the number of rows there ever were.
+ChangeLog = Table("ChangeLog", "Id         INTEGER PRIMARY KEY AUTOINCREMENT",
+                               "Tab        TEXT NOT NULL",
+                               "Name       TEXT NOT NULL")
+
+# The tables whose changes are logged, and the column naming the logged row.
+# Sellers are logged by item, since clients keep each item's sellers together.
+logged_tables = [(Items, "Name"), (Sellers, "ItemName"), (Users, "Name")]
+
+def change_version(conn):
+    """The version of the latest change, or 0 if nothing was logged yet."""
+    return ChangeLog.aggregate(conn, "COALESCE(MAX(Id), 0)", None)
+
+#### Request Metrics ###########################################################
+
+# Every request served through run_action() records how long it took, how long
+# it waited for the database lock, how many SQL statements it ran, how many rows
+# those returned and how big the response was. These are kept in their own
+# database, so that recording them never waits on the store, for
+# metrics_retention.
+metrics_database = os.environ.get(
+    'LIMBO_METRICS', os.path.splitext(sql_database)[0] + '-metrics.db')
+metrics_retention = datetime.timedelta(days=7)
+
+ActionMetrics = Table("ActionMetric", "Date          TEXT NOT NULL",
+                                      "Action        TEXT NOT NULL",
+                                      "Seconds       REAL NOT NULL",
+                                      "LockWait      REAL NOT NULL",
+                                      "Statements    INTEGER NOT NULL",
+                                      "Rows          INTEGER NOT NULL",
+                                      "ResponseBytes INTEGER NOT NULL",
+                                      "Failed        INTEGER NOT NULL")
+
+class RequestMetrics():
+    """What one request has done so far."""
+    def __init__(self, action):
+        self.action = action
+        self.lock_wait = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.response_bytes = 0
+        self.discarded = False
+
+    def discard(self):
+        """Don't record this request, e.g. because it is measured elsewhere."""
+        self.discarded = True
+
+    def count_statement(self, statement):
+        self.statements += 1
+
+    def count_row(self, cursor, row):
+        self.rows += 1
+        return row
+
+class Metrics():
+    """Measures requests and keeps the results in metrics_database. Finished
+       requests are buffered and written in batches, so that most requests
+       don't pay for a second commit; whatever is left is written when the
+       process exits (after every request, for the cgi script)."""
+    flush_size = 100
+    flush_interval = 30.0 # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = threading.local()
+        self.pending = []
+        self.last_flush = time.monotonic()
+        atexit.register(self.flush)
+
+    def active(self):
+        """The RequestMetrics of the request this thread is serving, if any."""
+        return getattr(self.current, 'request', None)
+
+    @contextmanager
+    def measure(self, action):
+        """Use as "with metrics.measure(action) as request:" around serving a
+           request. Set request.response_bytes before the end of the block."""
+        request = RequestMetrics(action)
+        self.current.request = request
+        failed = True
+        start = time.perf_counter()
+        try:
+            yield request
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start
+            self.current.request = None
+            if not request.discarded:
+                self.record(request, seconds, failed)
+
+    def record(self, request, seconds, failed):
+        with self.lock:
+            self.pending.append((datetime.datetime.now(), request.action,
+                                 seconds, request.lock_wait,
+                                 request.statements, request.rows,
+                                 request.response_bytes, int(failed)))
+            due = (len(self.pending) >= self.flush_size or
+                   time.monotonic() - self.last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+            self.last_flush = time.monotonic()
+        if not rows:
+            return
+        try:
+            with DBConnection(database=metrics_database) as conn:
+                ActionMetrics.create(conn, if_not_exists=True)
+                conn.execute("CREATE INDEX IF NOT EXISTS ActionMetric_Date "
+                             "ON ActionMetric(Date)")
+                conn.executemany("INSERT INTO ActionMetric VALUES(%s)" %
+                                 ', '.join('?' * len(ActionMetrics.fields)),
+                                 rows)
+                ActionMetrics.delete(conn, "Date<?", datetime.datetime.now() -
+                                                     metrics_retention)
+        except sql.Error:
+            # Metrics are only a diagnostic; never fail a request over them.
+            pass
+
+    def summary(self, since):
+        """Returns, for each action served since the given date, a dictionary
+           of the number of requests, how many failed, p50/p90/p99/max of
+           their durations and the mean lock wait (in seconds), and the mean
+           number of statements, rows and response bytes."""
+        self.flush()
+        result = {}
+        with DBConnection(readonly=True, database=metrics_database) as conn:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name=?",
+                                (ActionMetrics.name,)).fetchone():
+                return result
+            for row in conn.execute(
+                    "SELECT Action, COUNT(*), SUM(Failed), AVG(LockWait), "
+                    "AVG(Statements), AVG(Rows), AVG(ResponseBytes) "
+                    "FROM ActionMetric WHERE Date>=? GROUP BY Action",
+                    (since,)):
+                action, count, failed, lock_wait, statements, rows, size = row
+                durations = [seconds for (seconds,) in conn.execute(
+                    "SELECT Seconds FROM ActionMetric "
+                    "WHERE Action=? AND Date>=? ORDER BY Seconds",
+                    (action, since))]
+                result[action] = dict(count=count, failed=failed,
+                                      p50=percentile(durations, 50),
+                                      p90=percentile(durations, 90),
+                                      p99=percentile(durations, 99),
+                                      max=durations[-1],
+                                      lock_wait=lock_wait,
+                                      statements=statements, rows=rows,
+                                      response_bytes=size)
+        return result
+
+metrics = Metrics()
+
+#### Schema Migrations #########################################################
+
+# Each migration takes the database schema from one version to the next. They
+# are applied in order by migrate(), which records every applied version in the
+# SchemaVersion table so that an existing limbo4.db can be upgraded in place.
+# Never change a migration once it has been used on the real database; add a
+# new one instead. Migrations must also work on a database freshly created by
+# initialize_test_database(), which creates the tables as defined above.
+SchemaVersions = Table("SchemaVersion", "Version INTEGER PRIMARY KEY NOT NULL",
+                                        "Name    TEXT NOT NULL",
+                                        "Date    TEXT NOT NULL")
+
+migrations = []
+
+def migration(version):
+    """Decorator registering a function conn -> None as the migration to the
+       given schema version."""
+    def register(function):
+        assert all(version > v for v, _ in migrations)
+        migrations.append((version, function))
+        return function
+    return register
+
+def schema_version(conn):
+    """Returns the latest migration applied to the database, or 0."""
+    SchemaVersions.create(conn, if_not_exists=True)
+    row = conn.execute("SELECT MAX(Version) FROM SchemaVersion").fetchone()
+    return row[0] or 0
+
+def migrate():
+    """Applies all migrations which the database is missing, in a single
+       transaction. Returns a list of (version, name) applied."""
+    applied = []
+    with DBConnection() as conn:
+        current = schema_version(conn)
+        for version, function in migrations:
+            if version <= current:
+                continue
+            function(conn)
+            SchemaVersions.insert(conn, version, function.__name__,
+                                  datetime.datetime.now())
+            applied.append((version, function.__name__))
+    return applied
+
+@migration(1)
+def add_lookup_indexes(conn):
+    """Index every column we look rows up by. Dates are included so that a
+       user's history comes back in order without sorting."""
+    for name, table, columns in [
+            ("Sellers_ItemName",    "Sellers",        "ItemName"),
+            ("Sellers_Seller",      "Sellers",        "Seller"),
+            ("Purchases_Buyer",     "Purchases",      "Buyer, Date"),
+            ("Purchases_Seller",    "Purchases",      "Seller, Date"),
+            ("Transfers_Sender",    "Transfers",      "Sender, Date"),
+            ("Transfers_Receiver",  "Transfers",      "Receiver, Date"),
+            ("BalanceChanges_User", "BalanceChanges", "User, Date"),
+            ("Stocking_Seller",     "Stocking",       "Seller, Date"),
+            ("ExpiryEvent_Seller",  "ExpiryEvent",    "Seller, Date"),
+            ("Items_ExpiryDate",    "Items",          "ExpiryDate")]:
+        conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s(%s)" %
+                     (name, table, columns))
+
+def rebuild_table(conn, table, convert):
+    """Recreates a table with its current definition above, copying every old
+       row through convert(row) -> new row. Indexes on the table are kept.
+       (sqlite can't change the type of a column in place.)"""
+    indexes = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master "
+        "WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table.name,))]
+    conn.execute("ALTER TABLE %s RENAME TO %s_old" % (table.name, table.name))
+    table.create(conn)
+    rows = conn.execute("SELECT * FROM %s_old" % table.name)
+    conn.executemany("INSERT INTO %s VALUES(%s)" %
+                     (table.name, ', '.join('?' * len(table.fields))),
+                     (convert(row) for row in rows))
+    conn.execute("DROP TABLE %s_old" % table.name)
+    for index in indexes:
+        conn.execute(index)
+
+def declared_types(conn, name):
+    """The types of a table's columns as they are in the database."""
+    return [row[2] for row in conn.execute("PRAGMA table_info(%s)" % name)]
+
+@migration(2)
+def store_money_as_integers(conn):
+    """Convert money from text dollars to integer cents, and profit splits and
+       tax from text fractions to integer basis points."""
+    money = ('Balance', 'Price', 'PriceEach', 'Amount', 'AvgBalance',
+             'ExpectedCash')
+    fractions = ('ProfitSplit', 'Tax')
+    for table in (Users, Items, Sellers, Purchases, Transfers, BalanceChanges,
+                  Stocking, Donations, ExpiryEvents, Statistics):
+        types = [field.split()[1] for field in table.fields]
+        if declared_types(conn, table.name) == types:
+            continue # already created with the current definition
+        converters = []
+        for name in table.fieldnames:
+            if name in money:
+                converters.append(cents)
+            elif name in fractions:
+                converters.append(basis_points)
+            else:
+                converters.append(None)
+        def convert(row):
+            return tuple(value if f is None or value is None else f(value)
+                         for f, value in zip(converters, row))
+        rebuild_table(conn, table, convert)
+
+@migration(3)
+def add_ledger(conn):
+    """Create the ledger, starting every user off with an opening entry for
+       their current balance."""
+    Ledger.create(conn, if_not_exists=True)
+    LedgerCheckpoints.create(conn, if_not_exists=True)
+    conn.execute("CREATE INDEX IF NOT EXISTS Ledger_User ON Ledger(User, Id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS LedgerCheckpoint_User "
+                 "ON LedgerCheckpoint(User, LedgerId)")
+    if Ledger.count(conn, None) == 0:
+        conn.execute("INSERT INTO Ledger(Date, User, Amount, Kind) "
+                     "SELECT ?, Name, Balance, 'opening' FROM Users "
+                     "WHERE Balance != 0", (datetime.datetime.now(),))
+
+@migration(4)
+def add_table_versions(conn):
+    """Create TableVersion and the triggers keeping it up to date."""
+    TableVersions.create(conn, if_not_exists=True)
+    for table in versioned_tables:
+        conn.execute("INSERT OR IGNORE INTO TableVersion VALUES(?, 0)",
+                     (table.name,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute("CREATE TRIGGER IF NOT EXISTS %s_version_%s "
+                         "AFTER %s ON %s BEGIN "
+                         "UPDATE TableVersion SET Version=Version+1 "
+                         "WHERE Name='%s'; END" %
+                         (table.name, event.lower(), event, table.name,
+                          table.name))
+
+@migration(5)
+def add_change_log(conn):
+    """Create ChangeLog and the triggers filling it. Every existing row is
+       logged once, so that asking for the changes since version 0 returns
+       everything."""
+    ChangeLog.create(conn, if_not_exists=True)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ChangeLog_Row "
+                 "ON ChangeLog(Tab, Name)")
+    log = ("INSERT OR REPLACE INTO ChangeLog(Tab, Name) VALUES('%s', %s.%s);")
+    for table, column in logged_tables:
+        conn.execute("INSERT OR IGNORE INTO ChangeLog(Tab, Name) "
+                     "SELECT '%s', %s FROM %s" %
+                     (table.name, column, table.name))
+        for event, rows in (("INSERT", ("NEW",)),
+                            ("UPDATE", ("OLD", "NEW")),
+                            ("DELETE", ("OLD",))):
+            conn.execute("CREATE TRIGGER IF NOT EXISTS %s_changes_%s "
+                         "AFTER %s ON %s BEGIN %s END" %
+                         (table.name, event.lower(), event, table.name,
+                          ' '.join(log % (table.name, row, column)
+                                   for row in rows)))
+
+@migration(6)
+def add_user_names_version(conn):
+    """Give the list of usernames a version of its own, so that it stays cached
+       while balances change."""
+    conn.execute("INSERT OR IGNORE INTO TableVersion VALUES(?, 0)",
+                 (UserNames.name,))
+    for event in ("INSERT", "DELETE", "UPDATE OF Name"):
+        conn.execute("CREATE TRIGGER IF NOT EXISTS %s_version_%s "
+                     "AFTER %s ON %s BEGIN "
+                     "UPDATE TableVersion SET Version=Version+1 "
+                     "WHERE Name='%s'; END" %
+                     (UserNames.name, event.split()[0].lower(), event,
+                      Users.name, UserNames.name))
+
+# Queries which run on (nearly) every request, as (table, where clause). None of
+# these should need a full table scan; see query_plan() and migrate.py --check.
+hot_queries = [
+    (Users,          "Name=?"),
+    (Items,          "Name=?"),
+    (Items,          "ExpiryDate < ?"),
+    (Sellers,        "ItemName=?"),
+    (Sellers,        "Seller=?"),
+    (Purchases,      "Buyer=? OR Seller=?"),
+    (Transfers,      "Sender=? OR Receiver=?"),
+    (BalanceChanges, "User=?"),
+    (Stocking,       "Seller=?"),
+    (ExpiryEvents,   "Seller=?"),
+    (Purchases,      "Seller=? AND Date<=? AND (Date<? OR rowid<?) "
+                     "ORDER BY Date DESC, rowid DESC"),
+    (Ledger,         "User=? AND Id>?"),
+    (LedgerCheckpoints, "User=? ORDER BY LedgerId DESC"),
+    (ChangeLog,      "Id>?"),
+]
+
+def query_plan(conn, table, where):
+    """Returns the steps of sqlite's query plan for a select on the table, and
+       whether the rows are found by searching an index (or the primary key)
+       rather than by scanning a whole table or index."""
+    query = "EXPLAIN QUERY PLAN SELECT * FROM %s WHERE %s" % (table.name, where)
+    args = [None] * where.count('?')
+    steps = [row[-1] for row in conn.execute(query, args)]
+    indexed = not any(step.startswith('SCAN') for step in steps)
+    return steps, indexed
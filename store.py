@@ -1,7 +1,9 @@
-from browser import doc, html
-from limbo import async_request, sync_request, notify, redirect, Keycode
+from browser import doc, html, timer
+from limbo import async_request, cached_request, download, listen, notify, \
+    redirect, Keycode, KeyedOptions, dollars
 
 class Item():
+    """An item in stock. The price is in cents, as stored on the server."""
     def __init__(self, database_row):
         self.name, self.count, self.price, self.tax, self.stock_date, \
             self.expiry_date, self.desc = database_row
@@ -9,43 +11,51 @@ class Item():
         return "%s x%i" % (self.name, self.count)
 
 class StoreSession():
+    search_limit = 100 # most items shown for a search term
+    search_delay = 150 # ms without typing before the search is sent
+
     def __init__(self):
         self.username = eval(doc.query.getfirst("username", ""))
-        sync_request(self.get_store_info_done,
-                     action="store_info",
-                     username=repr(self.username))
-
-    def get_store_info_done(self, t):
-        userinfo, all_stock, usernames, \
-            user_stock, sellers_by_item, transactions = t
-        self.usernames = usernames
-        self.user_stock = user_stock
-        if not userinfo:
-            # Invalid username
-            redirect("index.html")
-        username, email, balance, uid, signup_date = userinfo
-        self.balance = float(balance)
-        doc["welcome"].html = ("Welcome, <b>%s</b>. Your balance is $%.2f." %
-                               (username, self.balance))
-        doc["new_balance"].html = ("Your new balance will be $%.2f" %
-                                   self.balance)
-
-        # Build a list of all things in-stock
-        inventory_list = list(map(Item, all_stock))
-        self.inventory = dict((item.name, item) for item in inventory_list)
-        self.in_stock = dict((item.name, item.count) for item in inventory_list)
+        self.usernames = []
+        self.balance = 0.0
+        self.inventory = {}
+        self.in_stock = {}
+        self.sellers_by_item = {}
+        self.user_stock = []
+        self.my_stock = {}
         self.checkout = {}
-
-        # And the user's own stock
-        self.my_stock = dict((itemname, self.inventory[itemname])
-                             for itemname in user_stock)
-
         # Keep track of stock amount changes (before confirmed)
-        self.to_add = dict((itemname, 0) for itemname in self.user_stock)
-
+        self.to_add = {}
         self.payment = 0.0
-        self.populate_lists()
-
+        self.seller_count = 1
+        self.history_cursor = None
+        self.newest_history = '' # date of the newest entry shown
+        self.loading_history = True
+        self.connected_before = False
+        self.search_term = ''
+        self.search_results = [] # the server's matches for search_term
+        self.search_timer = None
+        self.in_stock_list = KeyedOptions(doc["in_stock"], self.describe_item)
+        self.checkout_list = KeyedOptions(doc["checkout"], self.describe_item)
+        self.inventory_list = KeyedOptions(doc["inventory"],
+                                           self.describe_my_item)
+        self.bind_events()
+
+        # Stock and usernames are shown from the cache right away, and again
+        # if the server has newer ones.
+        cached_request(self.get_stock_done, action="stock")
+        cached_request(self.get_usernames_done, action="usernames")
+        async_request(self.get_user_done,
+                      action="username",
+                      username=self.username)
+        # Older transactions are loaded as the list is scrolled down.
+        async_request(self.get_history_done,
+                      action="history",
+                      username=self.username)
+        # From then on, changes made at other kiosks are pushed to us.
+        listen(self.apply_changes, self.push_connected)
+
+    def bind_events(self):
         doc["in_stock"].bind("click", self.select_item_event)
         doc["in_stock"].bind("dblclick", self.checkout_event)
         doc["in_stock"].bind("keyup", self.checkout_all_event)
@@ -56,23 +66,17 @@ class StoreSession():
 
         doc["clear_button"].bind("click", self.clear_items_event)
 
-        doc['search'].bind('keydown', self.search_event)
-        doc['search'].bind('keyup', self.search_event)
+        doc['search'].bind('input', self.search_event)
 
         doc['payment'].bind('keyup', self.set_payment_event)
-        self.payment = 0.0
 
         doc["inventory"].bind("dblclick", self.remove_inventory_event)
         doc["inventory"].bind("keyup", self.inventory_key_event)
 
         doc["add_seller"].bind("click", self.add_seller_space_event)
-        self.seller_count = 1
-
-        doc["usernames"].html = ''.join('<option value="%s">' % user
-                                        for user in self.usernames
-                                        if user != self.username)
 
         doc["add_item"].bind("click", self.stock_event)
+        doc["itemname"].bind("input", self.similar_items_event)
 
         doc['price'].bind('keyup', self.change_profits_event)
         doc['tax'].bind('keyup', self.change_profits_event)
@@ -87,45 +91,155 @@ class StoreSession():
         doc['transfer_button'].bind('click', self.transfer_event)
         
         doc['export_transactions'].bind('click', self.export_transactions)
-        
-        self.sellers_by_item = sellers_by_item
-
-        # Populate the list of transactions.
-        ## TODO: when a transaction is clicked on, shows more info
-        purchases, transfers, balances, stocks, expiries = transactions
-
-        entries = [] # Transaction entries to show
-        for purchase in purchases:
-            item, date, stockdate, expirydate, buyer, seller, profit_split, \
-                price_each, count, tax = purchase
-            entry = ("<option>{0}: {1}x {2} at ${3} each; "
-                     "{4} sold to {5}.</option>")
-            entries.append(entry.format(date[:19], count, item,
-                                        price_each, seller, buyer))
-
-        for transfer in transfers:
-            date, sender, receiver, amount = transfer
-            entry = "<option>{0}: transfer ${1} from {2} to {3}</option>"
-            entries.append(entry.format(date[:19], amount, sender, receiver))
-
-        for balance in balances:
-            date, user, amount = balance
-            if float(amount) > 0:
-                entry = "<option>{0}: deposited ${1}</option>"
-                entries.append(entry.format(date[:19], amount))
+
+        doc["transactions"].bind('scroll', self.history_scroll_event)
+
+    def get_user_done(self, userinfo):
+        if not userinfo:
+            # Invalid username
+            redirect("index.html")
+            return
+        username, email, balance, uid, signup_date = userinfo
+        self.balance = balance / 100
+        doc["welcome"].html = ("Welcome, <b>%s</b>. Your balance is $%.2f." %
+                               (username, self.balance))
+        self.populate_lists()
+
+    def get_usernames_done(self, usernames):
+        self.usernames = usernames
+        doc["usernames"].html = ''.join('<option value="%s">' % user
+                                        for user in self.usernames
+                                        if user != self.username)
+
+    def get_stock_done(self, stock):
+        """Shows the items in stock. This may be called a second time with
+           newer stock, so whatever is in the cart is kept, as far as it is
+           still in stock."""
+        all_stock, self.sellers_by_item = stock
+        inventory_list = list(map(Item, all_stock))
+        self.inventory = dict((item.name, item) for item in inventory_list)
+        self.checkout = dict((itemname, min(count,
+                                            self.inventory[itemname].count))
+                             for itemname, count in self.checkout.items()
+                             if itemname in self.inventory)
+        self.in_stock = dict((item.name,
+                              item.count - self.checkout.get(item.name, 0))
+                             for item in inventory_list)
+
+        # And the user's own stock
+        self.user_stock = [item.name for item in inventory_list
+                           if self.username in
+                              self.sellers_by_item.get(item.name, ())]
+        self.my_stock = dict((itemname, self.inventory[itemname])
+                             for itemname in self.user_stock)
+        self.to_add = dict((itemname, self.to_add.get(itemname, 0))
+                           for itemname in self.user_stock)
+        self.populate_lists()
+
+    def push_connected(self):
+        """Catch up on whatever changed while we weren't connected to the push
+           server. The first time, the requests above do that already."""
+        if self.connected_before:
+            async_request(self.get_stock_done, action="stock")
+            async_request(self.get_user_done,
+                          action="username",
+                          username=self.username)
+        self.connected_before = True
+
+    def apply_changes(self, changes):
+        """Patches the stock, the sellers and the users with the changes pushed
+           by the server (see changes_since), keeping the cart as far as the
+           items are still in stock."""
+        for row in changes['items']:
+            item = Item(row)
+            self.inventory[item.name] = item
+            in_cart = min(self.checkout.get(item.name, 0), item.count)
+            if in_cart:
+                self.checkout[item.name] = in_cart
             else:
-                entry = "<option>{0}: withdrew ${1}</option>"
-                entries.append(entry.format(date[:19], -float(amount)))
-
-        for stock in stocks:
-            item, date, stockdate, expirydate, seller, profit_split, \
-                price_each, oldcount, newcount, tax = stock
-            entry = ("<option>{0}: change stock from {1} to "
-                     "{2}x {3} (${4} each)</option>")
-            entries.append(entry.format(date[:19], oldcount, newcount,
-                                        item, price_each))
-        
-        doc["transactions"].html = ''.join(reversed(sorted(entries)))
+                self.checkout.pop(item.name, None)
+            self.in_stock[item.name] = item.count - in_cart
+            if item.name in self.my_stock:
+                self.my_stock[item.name] = item
+        for itemname in changes['deleted_items']:
+            for items in (self.inventory, self.in_stock, self.checkout,
+                          self.sellers_by_item, self.my_stock, self.to_add):
+                items.pop(itemname, None)
+        for itemname, splits in changes['sellers'].items():
+            sellers = [seller for seller, split in splits]
+            if sellers:
+                self.sellers_by_item[itemname] = sellers
+            else:
+                self.sellers_by_item.pop(itemname, None)
+            if self.username in sellers and itemname in self.inventory:
+                self.my_stock[itemname] = self.inventory[itemname]
+                self.to_add.setdefault(itemname, 0)
+            else:
+                self.my_stock.pop(itemname, None)
+                self.to_add.pop(itemname, None)
+        self.user_stock = list(self.my_stock)
+
+        if self.username in changes['users']:
+            if changes.get('user'):
+                # Our own write actions come with our row.
+                self.get_user_done(changes['user'])
+            else:
+                # Only names are pushed, so we ask for our new balance.
+                async_request(self.get_user_done,
+                              action="username",
+                              username=self.username)
+        new_users = [user for user in changes['users']
+                     if user not in self.usernames]
+        if new_users or changes['deleted_users']:
+            self.get_usernames_done(
+                [user for user in self.usernames
+                 if user not in changes['deleted_users']] + new_users)
+        self.populate_lists()
+
+    def get_history_done(self, page):
+        doc["transactions"].html = ''
+        entries, cursor = page
+        if entries:
+            self.newest_history = entries[0]['date']
+        self.add_history_done(page)
+
+    def add_new_history(self, entries):
+        """Puts entries newer than those shown at the top of the history."""
+        entries = [entry for entry in entries
+                   if entry['date'] > self.newest_history]
+        if entries:
+            self.newest_history = entries[0]['date']
+            doc["transactions"].html = (
+                ''.join('<option>%s</option>' % entry['text']
+                        for entry in entries) + doc["transactions"].html)
+
+    def apply_write_result(self, result):
+        """Shows what a write action of ours changed (see select_write_result
+           on the server), without loading the page again."""
+        self.apply_changes(result)
+        self.add_new_history(result['history'])
+
+    def add_history_done(self, page):
+        """Appends a page of history (entries, cursor) to the list. The
+           entries come newest first, each with its text."""
+        entries, self.history_cursor = page
+        doc["transactions"].html += ''.join('<option>%s</option>' %
+                                            entry['text'] for entry in entries)
+        self.loading_history = False
+
+    def history_scroll_event(self, ev):
+        """Loads the next page of history when the list is scrolled close to
+           its end."""
+        element = doc["transactions"]
+        if self.loading_history or self.history_cursor is None:
+            return
+        if element.scrollTop + element.clientHeight < element.scrollHeight - 40:
+            return
+        self.loading_history = True
+        async_request(self.add_history_done,
+                      action="history",
+                      username=self.username,
+                      before=self.history_cursor)
 
     def transfer_event(self, ev):
         """The user has clicked the 'transfer' button to transfer some of their
@@ -146,34 +260,46 @@ class StoreSession():
         if target not in self.usernames:
             notify("Invalid username")
             return
-        async_request(self.done_checkout,
+        async_request(self.done_transfer,
                       action='transfer',
-                      sender=repr(self.username),
-                      receiver=repr(target),
+                      sender=self.username,
+                      receiver=target,
                       amount=amount)
+
+    def done_transfer(self, res):
+        if res:
+            doc['transfer_amount'].value = ''
+            self.apply_write_result(res)
+        else:
+            notify("Transaction Failed")
     
     def export_transactions(self, ev):
-        redirect("cgi-bin/limbo-cgi.py",
-                 action="transactions.csv",
-                 username=repr(self.username))
+        """Downloads the user's history as CSV, only from and before the dates
+           given and of the kind chosen, if any."""
+        filters = {}
+        if doc["export_start"].value:
+            filters["start"] = doc["export_start"].value
+        if doc["export_end"].value:
+            filters["end"] = doc["export_end"].value
+        if doc["export_kind"].value:
+            filters["kinds"] = [doc["export_kind"].value]
+        download("transactions.csv", username=self.username, **filters)
     
     def checkout_submit_event(self, ev):
-        """The user has clicked the checkout submit button. Send an async
-           request for each item."""
-        ## TODO: it might be better to just send one request. As it stands, it
-        ##       might be possible for the transaction to fail halfway through
-        ##       and be partially successful (which is bad).
-        for child in doc['checkout']:
-            item = child.id
-            count = child.count
-            async_request(action="checkout",
-                          itemname=repr(item),
-                          buyername=repr(self.username),
-                          count=count)
+        """The user has clicked the checkout submit button. The whole cart and
+           the payment are sent in one request, which either succeeds or fails
+           as a whole."""
+        payment = doc['payment'].value or '0'
+        try:
+            float(payment)
+        except ValueError:
+            notify("Payment must be a number")
+            return
         async_request(self.done_checkout,
-                      action="balance",
-                      username=repr(self.username),
-                      amount=doc['payment'].value)
+                      action="checkout_cart",
+                      buyername=self.username,
+                      cart=self.checkout,
+                      payment=payment)
 
     def clear_to_addremove_event(self, ev):
         """Clears the inventory stock amount modifications."""
@@ -182,18 +308,32 @@ class StoreSession():
 
     def confirm_addremove_event(self, ev):
         """Confirms changes in inventory."""
-        for child in doc['inventory']:
-            item = child.id
-            to_add = self.to_add[item]
+        for item, to_add in self.to_add.items():
             if to_add != 0:
-                async_request(self.done_checkout,
+                async_request(self.addremove_done(item),
                               action="addremove",
-                              itemname=repr(item),
-                              count_to_add=to_add)
+                              itemname=item,
+                              count_to_add=to_add,
+                              username=self.username)
+
+    def addremove_done(self, itemname):
+        """The callback of the request changing the stock of one item."""
+        def done(res):
+            if res:
+                if itemname in self.to_add:
+                    self.to_add[itemname] = 0
+                self.apply_write_result(res)
+            else:
+                notify("Transaction Failed")
+        return done
 
     def done_checkout(self, res):
+        """The cart has been bought, or nothing has if res is False."""
         if res:
-            redirect("store.html", username=repr(self.username))
+            self.checkout = {}
+            self.payment = 0.0
+            doc['payment'].value = ''
+            self.apply_write_result(res)
         else:
             notify("Transaction Failed")
 
@@ -205,36 +345,35 @@ class StoreSession():
         self.populate_lists()
 
     def populate_lists(self):
-        """Fills the selection lists"""
-        option = ("<option value=\"{0}\" id=\"{0}\" count={1}>"
-                  "{1}x {0} (${2})</option>")
-
-        doc["in_stock"].html = ''.join(
-            option.format(itemname,
-                          amount,
-                          self.inventory[itemname].price)
-            for itemname, amount in self.in_stock.items())
-        doc["checkout"].html = ''.join(
-            option.format(itemname,
-                          amount,
-                          self.inventory[itemname].price)
-            for itemname, amount in self.checkout.items())
-
-        total = sum(amount * float(self.inventory[itemname].price)
-                    for itemname, amount in self.checkout.items())
+        """Fills the selection lists. Only the options which changed are
+           touched (see KeyedOptions), since this runs on every click and
+           keypress."""
+        self.in_stock_list.render([
+            (itemname, (self.in_stock[itemname],
+                        self.inventory[itemname].price))
+            for itemname in self.items_shown()])
+        self.checkout_list.render([
+            (itemname, (amount, self.inventory[itemname].price))
+            for itemname, amount in self.checkout.items()])
+
+        total = sum(amount * self.inventory[itemname].price
+                    for itemname, amount in self.checkout.items()) / 100
         doc["total"].html = "Your total is $%.2f" % total
         new_balance = self.balance - total + self.payment
         doc["new_balance"].html = "Your new balance will be $%.2f" % new_balance
 
-        option = ("<option value=\"{0}\" id=\"{0}\" count={1}>"
-                  "{1}x {0} (${2}) {3}</option>")
-        doc["inventory"].html = ''.join(
-            option.format(itemname,
-                          item.count,
-                          item.price,
-                          "[To Change: %i]" % self.to_add[itemname]
-                          if self.to_add[itemname] else "")
-            for itemname, item in self.my_stock.items())
+        self.inventory_list.render([
+            (itemname, (item.count, item.price, self.to_add[itemname]))
+            for itemname, item in self.my_stock.items()])
+
+    def describe_item(self, itemname, value):
+        amount, price = value
+        return "%ix %s ($%s)" % (amount, itemname, dollars(price))
+
+    def describe_my_item(self, itemname, value):
+        count, price, to_add = value
+        change = "[To Change: %i]" % to_add if to_add else ""
+        return "%ix %s ($%s) %s" % (count, itemname, dollars(price), change)
 
     def select_item_event(self, ev):
         """Single-clicking on an item should show its description"""
@@ -305,18 +444,49 @@ class StoreSession():
         self.checkout = {}
         self.populate_lists()
 
+    def items_shown(self):
+        """The items in stock matching the search term, best first, or all of
+           them if there is no term or nothing matches."""
+        if self.search_term:
+            shown = [itemname for itemname in self.search_results
+                     if itemname in self.in_stock]
+            if shown:
+                return shown
+        return list(self.in_stock)
+
     def search_event(self, ev):
-        """Whenever the search term is altered, filters items shown."""
-        search_term = doc["search"].value.lower()
-        # Hide all in_stock items which don't satisfy the search term
-        all_hidden = True
-        for option in doc["in_stock"].children:
-            option.hidden = search_term not in option.value.lower()
-            all_hidden = all_hidden and option.hidden
-        # ...unless none of them satisfy the search term
-        if all_hidden:
-            for option in doc["in_stock"].children:
-                option.hidden = False
+        """Whenever the search term is altered, asks the server for the items
+           matching it, once typing pauses. The server keeps an index of them
+           (see search.py), which is much quicker than looking through them
+           here. Meanwhile, the items found last are narrowed down to those
+           whose names contain the words typed."""
+        self.search_term = doc["search"].value
+        if self.search_timer is not None:
+            timer.clear_timeout(self.search_timer)
+            self.search_timer = None
+        words = self.search_term.lower().split()
+        if not words:
+            self.search_results = []
+            self.populate_lists()
+            return
+        narrowed = [itemname for itemname in self.search_results
+                    if all(word in itemname.lower() for word in words)]
+        if narrowed:
+            self.search_results = narrowed
+            self.populate_lists()
+        self.search_timer = timer.set_timeout(self.send_search,
+                                              self.search_delay)
+
+    def send_search(self):
+        self.search_timer = None
+        async_request(self.search_done, action="search",
+                      query=self.search_term, limit=self.search_limit)
+
+    def search_done(self, results):
+        # Replies may arrive out of order; only the latest term's counts.
+        if results['query'] == self.search_term:
+            self.search_results = results['items']
+            self.populate_lists()
 
     def inventory_key_event(self, ev):
         """Any key event which changes our stock counts (non-final)."""
@@ -373,8 +543,35 @@ class StoreSession():
         doc["your_income"].html = '$%.2f' % (percent * listed_price_each)
 
     def stock_item_done(self, res):
-        """Refresh when an item is stocked."""
-        redirect("store.html", username=repr(self.username))
+        """Show the new item once it is stocked."""
+        if res:
+            doc["itemname"].value = ''
+            doc["desc_text_area"].value = ''
+            doc["similar_items"].text = ''
+            self.apply_write_result(res)
+        else:
+            notify("Transaction Failed")
+
+    def similar_items_event(self, ev):
+        """As a new item's name is typed, shows the items in stock most like
+           it, so that the seller can stock more of one of them instead of
+           the same thing under another name."""
+        name = doc["itemname"].value
+        if len(name.strip()) < 3:
+            doc["similar_items"].text = ''
+            return
+        async_request(self.similar_items_done, action="similar_items",
+                      itemname=name, description=doc["desc_text_area"].value)
+
+    def similar_items_done(self, similar):
+        # Replies may arrive out of order; only the latest name's counts.
+        if similar['itemname'] != doc["itemname"].value:
+            return
+        if similar['items']:
+            doc["similar_items"].text = ("Similar items in stock: " +
+                                         ", ".join(similar['items']))
+        else:
+            doc["similar_items"].text = ''
 
     def stock_event(self, ev):
         """Validate the form for stocking items and then stock the item."""
@@ -403,6 +600,9 @@ class StoreSession():
         except ValueError:
             notify("Invalid price")
             return
+        if price_float < 0:
+            notify("Invalid price. Must not be negative.")
+            return
         if not doc["tax"].value:
             notify("Invalid tax")
             return
@@ -450,14 +650,10 @@ class StoreSession():
         # The seller with profit listed as "None" will get the remaining amount
         sellers[self.username] = None
         
-        print(dict(itemname=repr(name), sellers=sellers, count=count,
-                              price_each=repr(price), tax=repr(tax), expiry_time_in_weeks=expiry,
-                                                    description=repr(description)))
-        
-        async_request(on_complete=self.done_checkout,
+        async_request(on_complete=self.stock_item_done,
                       action="add_item",
-                      itemname=repr(name), sellers=sellers, count=count,
-                      price_each=repr(price), tax=repr(tax), expiry_time_in_weeks=expiry,
-                      description=repr(description))
+                      itemname=name, sellers=sellers, count=count,
+                      price_each=price, tax=tax, expiry_time_in_weeks=expiry,
+                      description=description, username=self.username)
 
 StoreSession()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Long-running server for Limbo4. This serves the same actions as the cgi
+# script, but without starting a new python process for every request.
+#
+# Either run it directly:
+#     ./wsgi.py --port 8000
+# and proxy cgi-bin/limbo-cgi.py to it, or hand `application` to any WSGI
+# server (mod_wsgi, gunicorn, ...).
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from urllib.parse import parse_qs
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from actions import run_action, wire_format, response_etag, Download
+
+def read_form(environ):
+    """Returns a dictionary of the arguments sent with the request, whether in
+       the query string or in an url-encoded POST body. Like
+       cgi.FieldStorage.getfirst, only the first value of an argument is
+       kept."""
+    fields = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+    if environ.get('REQUEST_METHOD') == 'POST':
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length).decode('utf-8')
+        for name, values in parse_qs(body, keep_blank_values=True).items():
+            fields.setdefault(name, []).extend(values)
+    return dict((name, values[0]) for name, values in fields.items())
+
+def etag_matches(environ, etag):
+    """Whether the client's If-None-Match header lists the ETag."""
+    header = environ.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+def application(environ, start_response):
+    form = read_form(environ)
+    action = form.get("action", "")
+    etag = response_etag(action, form)
+    if etag is not None and etag_matches(environ, etag):
+        start_response('304 Not Modified', [('ETag', etag)])
+        return []
+    response = run_action(action, form)
+    if isinstance(response, Download):
+        # Streamed as it is produced, so there is no Content-Length.
+        start_response('200 OK', [
+            ('Content-Type', response.content_type),
+            ('Content-Disposition',
+             'attachment; filename="%s"' % response.filename)])
+        return response
+    body = response.encode('utf-8')
+    content_type = wire_format(form)[2]
+    headers = [('Content-Type', content_type),
+               ('Content-Length', str(len(body)))]
+    if etag is not None:
+        # Always check with us before reusing the response.
+        headers += [('ETag', etag), ('Cache-Control', 'no-cache')]
+    start_response('200 OK', headers)
+    return [body]
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Handles each request in its own thread, so that one slow request doesn't
+       hold up every other kiosk."""
+    daemon_threads = True
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve(host='127.0.0.1', port=8000, quiet=False):
+    handler = QuietRequestHandler if quiet else WSGIRequestHandler
+    return make_server(host, port, application,
+                       server_class=ThreadingWSGIServer,
+                       handler_class=handler)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve Limbo4 actions.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't log every request")
+    args = parser.parse_args()
+    httpd = serve(args.host, args.port, args.quiet)
+    print("Serving Limbo4 on http://%s:%i/" % httpd.server_address)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass